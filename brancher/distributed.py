@@ -0,0 +1,162 @@
+"""
+Distributed
+---------
+Tools for running inference in several processes with torch.distributed. Each process (rank) draws its share of the
+Monte Carlo samples, the gradients of the learnable parameters are all-reduced before each step of the optimizers and
+the parameters are broadcasted from rank 0 at the beginning of the inference, so that they stay identical across ranks.
+The observed data can also be sharded: each rank observes a slice of the data (RandomVariable.observe(data,
+sharded=True)) and evaluates the likelihood of its slice for the same samples of the latent variables, the partial
+log probabilities and gradients are summed across ranks.
+The process group has to be initialized by the user (e.g. torch.distributed.init_process_group("gloo", ...)).
+"""
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    """
+    It returns True if a torch.distributed process group has been initialized.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def split_number_samples(number_samples, rank=None, world_size=None):
+    """
+    It returns the number of samples drawn by a rank. The samples are split as evenly as possible across ranks.
+
+    Args:
+        number_samples: Int. Total number of samples.
+
+        rank: Int.
+
+        world_size: Int.
+
+    Returns:
+        Int.
+    """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    if number_samples < world_size:
+        raise ValueError("The number of samples ({}) should be at least the number of processes ({})".format(number_samples,
+                                                                                                           world_size))
+    return number_samples // world_size + (1 if rank < number_samples % world_size else 0)
+
+
+def get_shard(data, rank=None, world_size=None):
+    """
+    It returns the slice of the data (along the first axis, the datapoints) that is owned by a rank. The data is split
+    as evenly as possible across ranks.
+
+    Args:
+        data: torch.Tensor or np.ndarray.
+
+        rank: Int.
+
+        world_size: Int.
+
+    Returns:
+        torch.Tensor or np.ndarray.
+    """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    shard_sizes = [split_number_samples(len(data), r, world_size) for r in range(world_size)]
+    start = sum(shard_sizes[:rank])
+    return data[start:start + shard_sizes[rank]]
+
+
+def synchronize_rng_state(source_rank=0):
+    """
+    It copies the state of the torch random number generator from the source rank to all the other ranks and reseeds
+    numpy from it, so that all ranks draw the same samples.
+    """
+    rng_state = torch.get_rng_state()
+    dist.broadcast(rng_state, src=source_rank)
+    torch.set_rng_state(rng_state)
+    np.random.seed(int(torch.randint(0, 2**31 - 1, (1,))))
+
+
+def offset_rng_state():
+    """
+    It reseeds the torch and numpy random number generators with a seed that depends on the rank. The seed is drawn
+    from the current state of the generator, so that ranks starting from the same state draw different samples while
+    the run stays reproducible.
+    """
+    seed = int(torch.randint(0, 2**31 - 1 - get_world_size(), (1,))) + get_rank()
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+
+
+def all_gather_object(obj):
+    """
+    It returns the list of the (picklable) objects of all the ranks, sorted by rank.
+    """
+    objects = [None]*get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def _get_parameters(optimizers_list, extra_parameters=None):
+    parameters = []
+    seen = set()
+    for parameter in [parameter for opt in optimizers_list for parameter in opt.module.parameters()] + \
+                     list(extra_parameters if extra_parameters else []):
+        if parameter not in seen:
+            seen.add(parameter)
+            parameters.append(parameter)
+    return parameters
+
+
+def broadcast_parameters(optimizers_list, source_rank=0, extra_parameters=None):
+    """
+    It copies the values of the parameters of all the optimizers, and of the extra parameters, from the source rank to
+    all the other ranks.
+    """
+    with torch.no_grad():
+        for parameter in _get_parameters(optimizers_list, extra_parameters):
+            dist.broadcast(parameter.data, src=source_rank)
+
+
+def all_reduce_gradients(optimizers_list, loss, weight, extra_parameters=None):
+    """
+    It replaces the local gradients and loss with their weighted sum across ranks. The gradients and the loss are
+    reduced in their own dtype, in a single all-reduce call per dtype.
+
+    Args:
+        optimizers_list: List(brancher.optimizers.ProbabilisticOptimizer).
+
+        loss: torch.Tensor. The local loss.
+
+        weight: Float. Weight of the rank in the sum (e.g. its fraction of the samples).
+
+        extra_parameters: List(torch.Tensor). Parameters that are not optimized by the optimizers (e.g. the particles
+        updated by the inference method) whose gradients are also reduced.
+
+    Returns:
+        torch.Tensor. The (detached) reduced loss.
+    """
+    parameters = _get_parameters(optimizers_list, extra_parameters)
+    for parameter in parameters:
+        if parameter.grad is None:
+            parameter.grad = torch.zeros_like(parameter)
+    loss = loss.detach().reshape(-1).clone()
+    tensors_by_dtype = {}
+    for tensor in [parameter.grad for parameter in parameters] + [loss]:
+        tensors_by_dtype.setdefault(tensor.dtype, []).append(tensor)
+    for tensors in tensors_by_dtype.values(): # Each dtype is reduced in its own buffer, without loss of precision
+        flat_buffer = torch.cat([tensor.reshape(-1) for tensor in tensors])*weight
+        dist.all_reduce(flat_buffer, op=dist.ReduceOp.SUM)
+        offset = 0
+        for tensor in tensors:
+            number_elements = tensor.numel()
+            tensor.copy_(flat_buffer[offset:offset + number_elements].view_as(tensor))
+            offset += number_elements
+    return loss
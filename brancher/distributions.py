@@ -27,6 +27,8 @@ class Distribution(ABC):
     """
     Summary
     """
+    has_rsample = True # The samples are differentiable with respect to the parameters (reparameterization)
+
     def __init__(self):
         pass
 
@@ -78,7 +80,7 @@ class ContinuousDistribution(Distribution):
 
 
 class DiscreteDistribution(Distribution):
-    pass
+    has_rsample = False
 
 
 class UnivariateDistribution(Distribution):
@@ -163,6 +165,8 @@ class CategoricalDistribution(VectorDistribution):
     """
     Summary
     """
+    has_rsample = False
+
     def __init__(self):
         self.required_parameters = {("p", "softmax_p")}
         self.optional_parameters = {}
@@ -0,0 +1,195 @@
+"""
+Expressions
+---------
+Expression graphs of the partial links. A PartialLink records the operations between variables as a graph of
+variable leaves, constants and operations. The graph is compiled into a flat program that evaluates every node exactly
+once per pass, after eliminating the common subexpressions and folding the constant subexpressions.
+"""
+import numbers
+
+
+class ExpressionNode(object):
+    """
+    ExpressionNode is the superclass of all the nodes of an expression graph.
+    """
+    inputs = ()
+
+
+class VariableNode(ExpressionNode):
+    """
+    Leaf node. It evaluates to the value of a brancher variable.
+    """
+    def __init__(self, variable):
+        self.variable = variable
+
+
+class ConstantNode(ExpressionNode):
+    """
+    Leaf node. It evaluates to a constant value.
+    """
+    def __init__(self, value):
+        self.value = value
+
+
+class OperationNode(ExpressionNode):
+    """
+    Node that applies an operation to the values of its argument nodes.
+
+    Parameters
+    ----------
+    operation : callable
+        The operation. It receives the values of the args and kwargs nodes.
+    args : tuple of ExpressionNode
+        Positional arguments of the operation.
+    kwargs : dict of ExpressionNode
+        Keyword arguments of the operation.
+    pure : bool
+        If True, the operation is deterministic and stateless: two nodes with the same operation and the same arguments
+        are merged and the node is evaluated at compile time when all its arguments are constants that do not require
+        gradients. In-place operations and operations that allocate a new tensor (e.g. empty) are not pure.
+    """
+    def __init__(self, operation, args=(), kwargs=None, pure=True):
+        self.operation = operation
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs) if kwargs else {}
+        self.pure = pure
+
+    @property
+    def inputs(self):
+        return self.args + tuple(self.kwargs.values())
+
+
+def pack_tuple(*args):
+    return tuple(args)
+
+
+def get_shape(value):
+    return value.shape
+
+
+def _is_value_constant(value):
+    if value is None or isinstance(value, (numbers.Number, str)):
+        return True
+    if isinstance(value, tuple):
+        return all([_is_value_constant(element) for element in value])
+    return False
+
+
+def _requires_grad(value):
+    if isinstance(value, (tuple, list)):
+        return any([_requires_grad(element) for element in value])
+    return bool(getattr(value, "requires_grad", False))
+
+
+def _constant_key(value):
+    if _is_value_constant(value):
+        return ConstantNode, type(value), value
+    return ConstantNode, id(value)
+
+
+def _topological_sort(roots):
+    order = []
+    visited = set()
+    for root in roots:
+        stack = [(root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+                continue
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            stack.append((node, True))
+            stack.extend([(input_node, False) for input_node in reversed(node.inputs)
+                          if id(input_node) not in visited])
+    return order
+
+
+class CompiledExpression(object):
+    """
+    Flat program that evaluates one or several expression graphs. The nodes are stored in registers in topological order.
+    Nodes that are structurally identical share the same register and constant subexpressions are evaluated at compile
+    time. Constants that require gradients are never folded, so that each call builds its own autograd graph.
+
+    Parameters
+    ----------
+    outputs : ExpressionNode or dict of ExpressionNode
+        The root nodes of the expressions. If a dictionary is given, calling the compiled expression returns a
+        dictionary with the same keys.
+    """
+    def __init__(self, outputs):
+        self.is_dict = isinstance(outputs, dict)
+        roots = list(outputs.values()) if self.is_dict else [outputs]
+        self.initial_registers = []
+        self.variable_loads = []
+        self.instructions = []
+        registers = {}
+        keys = {}
+        constant_registers = set()
+
+        for node in _topological_sort(roots):
+            if isinstance(node, VariableNode):
+                key = (VariableNode, id(node.variable))
+            elif isinstance(node, ConstantNode):
+                key = _constant_key(node.value)
+            else:
+                arg_registers = tuple([registers[id(arg)] for arg in node.args])
+                kwarg_registers = tuple(sorted([(name, registers[id(arg)]) for name, arg in node.kwargs.items()]))
+                if node.pure:
+                    key = (OperationNode, id(node.operation), arg_registers, kwarg_registers)
+                else:
+                    key = (OperationNode, id(node))
+            if key in keys:
+                registers[id(node)] = keys[key]
+                continue
+
+            register = len(self.initial_registers)
+            self.initial_registers.append(None)
+            if isinstance(node, VariableNode):
+                self.variable_loads.append((register, node.variable))
+            elif isinstance(node, ConstantNode):
+                self.initial_registers[register] = node.value
+                if not _requires_grad(node.value): # Results computed from it would keep its (freed) graph
+                    constant_registers.add(register)
+            else:
+                is_foldable = node.pure and all([r in constant_registers for r in arg_registers]) and \
+                              all([r in constant_registers for _, r in kwarg_registers])
+                folded = False
+                if is_foldable:
+                    try:
+                        value = self._apply(node.operation, self.initial_registers, arg_registers, kwarg_registers)
+                        folded = not _requires_grad(value)
+                    except Exception:
+                        folded = False
+                    if folded:
+                        self.initial_registers[register] = value
+                        constant_registers.add(register)
+                if not folded:
+                    self.instructions.append((register, node.operation, arg_registers, kwarg_registers))
+            keys[key] = register
+            registers[id(node)] = register
+
+        if self.is_dict:
+            self.outputs = [(name, registers[id(node)]) for name, node in outputs.items()]
+        else:
+            self.outputs = registers[id(outputs)]
+
+    @staticmethod
+    def _apply(operation, registers, arg_registers, kwarg_registers):
+        return operation(*[registers[r] for r in arg_registers],
+                         **{name: registers[r] for name, r in kwarg_registers})
+
+    def __call__(self, values):
+        registers = list(self.initial_registers)
+        for register, variable in self.variable_loads:
+            registers[register] = values[variable]
+        for register, operation, arg_registers, kwarg_registers in self.instructions:
+            registers[register] = self._apply(operation, registers, arg_registers, kwarg_registers)
+        if self.is_dict:
+            return {name: registers[register] for name, register in self.outputs}
+        return registers[self.outputs]
+
+    @property
+    def number_operations(self):
+        return len(self.instructions)
@@ -3,9 +3,32 @@ import torch
 
 from brancher.variables import var2link
 from brancher.variables import Variable, PartialLink
+from brancher.expressions import OperationNode, ConstantNode
 from brancher.utilities import batch_meshgrid as torch_batch_meshgrid
 from brancher.utilities import delta as torch_delta
 
+_STOCHASTIC_FUNCTIONS = {"bernoulli", "binomial", "multinomial", "normal", "poisson", "rand", "rand_like", "randint",
+                         "randint_like", "randn", "randn_like", "randperm", "rrelu", "rrelu_", "gumbel_softmax"}
+
+_ALLOCATION_FUNCTIONS = {"empty", "empty_like", "empty_strided", "empty_permuted", "zeros", "zeros_like", "ones",
+                         "ones_like", "full", "full_like", "eye", "arange", "range", "linspace", "logspace", "tensor",
+                         "as_tensor", "from_numpy", "clone"}
+
+
+def _is_stochastic(fn):
+    name = getattr(fn, "__name__", "")
+    return "dropout" in name or name in _STOCHASTIC_FUNCTIONS
+
+
+def _is_impure(fn):
+    """
+    It returns True if the calls to the function should never be folded or merged: stochastic functions, in-place
+    functions (trailing underscore) and functions that allocate a new tensor, whose result can be modified in place.
+    """
+    name = getattr(fn, "__name__", "")
+    return _is_stochastic(fn) or (name.endswith("_") and not name.startswith("_")) or name in _ALLOCATION_FUNCTIONS
+
+
 class BrancherFunction(object):
     """
     Wrapper on backend functions (torch) for the user interface
@@ -19,20 +42,21 @@ class BrancherFunction(object):
             self.links = {fn}
         else:
             self.links = set()
+        self.is_pure = not self.links and not _is_impure(fn)
 
     def __call__(self, *args, **kwargs):
         link_args = [var2link(arg) for arg in args]
         link_kwargs = {name: var2link(arg) for name, arg in kwargs.items()}
         arg_vars = {var for link in link_args if isinstance(link, PartialLink) for var in link.vars}
         kwarg_vars = {var for _, link in link_kwargs.items() if isinstance(link, PartialLink) for var in link.vars}
-
-        def fn(values):
-            args = [x.fn(values) if isinstance(x, PartialLink) else x for x in link_args]
-            kwargs = dict({(name, x.fn(values)) if isinstance(x, PartialLink) else (name, x)
-                           for name, x in link_kwargs.items()})
-            return self.fn(*args, **kwargs)
-
-        return PartialLink(arg_vars.union(kwarg_vars), fn, self.links)
+        arg_links = {l for link in list(link_args) + list(link_kwargs.values()) if isinstance(link, PartialLink)
+                     for l in link.links}
+        node = OperationNode(self.fn,
+                             args=[x.node if isinstance(x, PartialLink) else ConstantNode(x) for x in link_args],
+                             kwargs={name: x.node if isinstance(x, PartialLink) else ConstantNode(x)
+                                     for name, x in link_kwargs.items()},
+                             pure=self.is_pure and "out" not in kwargs)
+        return PartialLink(arg_vars.union(kwarg_vars), node, self.links.union(arg_links))
 
     @staticmethod
     def _is_var(self, arg):
@@ -40,20 +64,32 @@ class BrancherFunction(object):
 
 # function set as a combination of torch.nn.functional and torch._C._VariableFunctions
 # comprises most operations on tensors, including math, reshashing, broadcasting and nn functions
+# The wrappers are created on first access and cached in the module namespace. When a name is defined in both
+# backends, the function in torch._C._VariableFunctions is used.
+
+is_backend_fn = lambda k, v: type(v) in [types.FunctionType, types.BuiltinFunctionType] and not k.startswith('_') #TODO: Work in progress
 
-fn_set = {}
 
-for name, fun in torch.nn.functional.__dict__.items():
-    fn_set[name] = getattr(torch.torch.nn.functional, name)
+def _get_backend_fn(name):
+    fn = getattr(torch._C._VariableFunctions, name, None)
+    if fn is None:
+        fn = torch.nn.functional.__dict__.get(name, None)
+    return fn
 
-for name in dir(torch._C._VariableFunctions):
-    if name.startswith('_'):
-        continue
-    fn_set[name] = getattr(torch.torch._C._VariableFunctions, name)
 
-is_backend_fn = lambda k, v: type(v) in [types.FunctionType, types.BuiltinFunctionType] and not k.startswith('_') #TODO: Work in progress
-brancher_fns = {name: BrancherFunction(v) for name, v in fn_set.items() if is_backend_fn(name, v)}
-globals().update(brancher_fns)
+def __getattr__(name):
+    fn = _get_backend_fn(name)
+    if fn is None or not is_backend_fn(name, fn):
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+    brancher_fn = BrancherFunction(fn)
+    globals()[name] = brancher_fn
+    return brancher_fn
+
+
+def __dir__():
+    backend_names = set(torch.nn.functional.__dict__.keys()).union(dir(torch._C._VariableFunctions))
+    return sorted(set(globals().keys()).union({name for name in backend_names
+                                               if is_backend_fn(name, _get_backend_fn(name))}))
 
 ## Custom functions ##
 batch_meshgrid = BrancherFunction(torch_batch_meshgrid)
@@ -3,19 +3,26 @@ Inference
 ---------
 Module description
 """
+import os
+import random
 import warnings
+import weakref
 from abc import ABC, abstractmethod
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from externals.tqdm.tqdm import tqdm
 
 import torch
 
+from brancher import distributed
 from brancher.optimizers import ProbabilisticOptimizer
 from brancher.variables import Variable, ProbabilisticModel
 from brancher.transformations import truncate_model
 from brancher.variables import DeterministicVariable
+from brancher.particle_inference_tools import ParticleSet
+from brancher.standard_variables import EmpiricalVariable
 
 from brancher.utilities import reassign_samples
 from brancher.utilities import zip_dict
@@ -46,16 +53,201 @@ from brancher.utilities import to_tensor
 #     return loss_list
 
 
+CHECKPOINT_FILENAME = "checkpoint.pt"
+DEFAULT_CONVERGENCE_CHECK_INTERVAL = 100
+
+
+class ConvergenceMonitor(object):
+    """
+    Convergence criterion on the stream of losses. It keeps an exponential moving average (EMA) of the loss and
+    the inference is considered converged when the EMA has not improved by more than a relative tolerance for a number
+    of consecutive iterations. Non-finite losses are ignored.
+
+    Parameters
+    ---------
+    tolerance : float
+        Minimal relative improvement of the EMA with respect to its best value.
+    patience : int
+        Number of consecutive iterations without improvement after which the inference is stopped.
+    decay : float
+        Decay of the exponential moving average.
+    """
+    def __init__(self, tolerance, patience=100, decay=0.9):
+        self.tolerance = tolerance
+        self.patience = patience
+        self.decay = decay
+        self.ema = None
+        self.best_ema = None
+        self.iterations_without_improvement = 0
+        self.converged = False
+
+    def update(self, losses):
+        """
+        Method. It updates the criterion with a chunk of losses and returns True if the inference has converged.
+        """
+        for loss in losses:
+            if self.converged:
+                break
+            if not np.isfinite(loss):
+                continue
+            self.ema = loss if self.ema is None else self.decay*self.ema + (1 - self.decay)*loss
+            if self.best_ema is None or self.best_ema - self.ema > self.tolerance*np.abs(self.best_ema):
+                self.best_ema = self.ema
+                self.iterations_without_improvement = 0
+            else:
+                self.iterations_without_improvement += 1
+                self.converged = self.iterations_without_improvement >= self.patience
+        return self.converged
+
+    def state_dict(self):
+        return {"ema": self.ema, "best_ema": self.best_ema,
+                "iterations_without_improvement": self.iterations_without_improvement, "converged": self.converged}
+
+    def load_state_dict(self, state_dict):
+        self.ema = state_dict["ema"]
+        self.best_ema = state_dict["best_ema"]
+        self.iterations_without_improvement = state_dict["iterations_without_improvement"]
+        self.converged = state_dict["converged"]
+
+
+def get_rng_state():
+    """
+    It returns the state of the torch, numpy and python random number generators.
+    """
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "python": random.getstate()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """
+    It restores the state of the random number generators returned by get_rng_state.
+    """
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_checkpoint(checkpoint_dir, iteration, optimizers_list, loss_list, convergence_monitor=None,
+                    inference_method=None, posterior_locations=None, rank_rng_states=None):
+    """
+    It saves the state of an inference run to checkpoint_dir. The file is written to a temporary file that is then
+    renamed, so that an interruption never leaves a corrupted checkpoint.
+
+    Parameters
+    ---------
+    checkpoint_dir : str
+        Directory of the checkpoint. It is created if it does not exist.
+    iteration : int
+        Number of completed iterations.
+    optimizers_list : list of brancher.ProbabilisticOptimizer
+    loss_list : list
+        Loss curve up to the current iteration.
+    convergence_monitor : brancher.inference.ConvergenceMonitor
+    inference_method : brancher.inference.InferenceMethod
+        Its state (see InferenceMethod.state_dict) is saved in the checkpoint.
+    posterior_locations : list of torch.Tensor
+        Locations of the particles of a ParticleSet posterior model that is updated by the inference method instead of
+        an optimizer.
+    rank_rng_states : list
+        States of the random number generators of all the ranks of a distributed inference, sorted by rank.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint = {"iteration": iteration,
+                  "optimizers": [opt.state_dict() for opt in optimizers_list],
+                  "loss curve": np.array(loss_list),
+                  "rng": get_rng_state()}
+    if convergence_monitor is not None:
+        checkpoint["convergence"] = convergence_monitor.state_dict()
+    if inference_method is not None:
+        checkpoint["inference method"] = inference_method.state_dict()
+    if posterior_locations is not None:
+        checkpoint["posterior locations"] = [location.detach().clone() for location in posterior_locations]
+    if rank_rng_states is not None:
+        checkpoint["rank rng"] = rank_rng_states
+    path = os.path.join(checkpoint_dir, CHECKPOINT_FILENAME)
+    temporary_path = path + ".tmp"
+    torch.save(checkpoint, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def load_checkpoint(path):
+    """
+    It loads a checkpoint saved by save_checkpoint. The path can be either the checkpoint file or its directory.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, CHECKPOINT_FILENAME)
+    return torch.load(path, weights_only=False)
+
+
 def perform_inference(joint_model, number_iterations, number_samples = 1,
                       optimizer='Adam', input_values={},
                       inference_method=None,
                       posterior_model=None, sampler_model=None,
-                      pretraining_iterations=0, **opt_params): #TODO: input values
+                      pretraining_iterations=0, loss_flush_interval=None,
+                      checkpoint_dir=None, checkpoint_interval=None, resume_from=None,
+                      convergence_tolerance=None, convergence_patience=100, ema_decay=0.9,
+                      scheduler=None, scheduler_params=None, accumulation_steps=1,
+                      distributed_samples=False, **opt_params): #TODO: input values
     """
     Summary
 
     Parameters
     ---------
+    loss_flush_interval : int
+        Number of iterations between transfers of the loss history from the device to
+        joint_model.diagnostics["loss curve"]. If None, the loss history is only transferred at the end of the
+        inference. The loss and its finiteness are never transferred to the host inside the training loop. The
+        iterations with a non-finite loss are skipped on the device: their gradients are left out of the gradient
+        accumulation and the optimizer steps without any finite gradient leave the parameters and the state of the
+        optimizers unchanged (see ProbabilisticOptimizer.update). The schedulers count all the iterations, including
+        the skipped ones, which are counted and reported when the loss history is transferred. Optimizers that
+        re-evaluate the loss in their step (e.g. LBFGS) receive zero gradients in those iterations instead.
+    checkpoint_dir : str
+        Directory where the state of the inference is saved every checkpoint_interval iterations and at the end of the
+        inference. The checkpoint contains the optimizers and parameters state, the iteration, the loss curve, the
+        state of the random number generators and the state of the inference method (see InferenceMethod.state_dict).
+        When the inference method updates the posterior model itself (e.g. StochasticGradientLangevinDynamics), the
+        locations of its particles are also saved.
+    checkpoint_interval : int
+        Number of iterations between checkpoints.
+    resume_from : str
+        Checkpoint file (or directory) of a previous run of the same models. The inference continues from the saved
+        iteration until number_iterations, reproducing the run that was interrupted. In a distributed inference, the
+        random number generators of each rank are saved and restored, so the run is only reproduced exactly when it is
+        resumed with the same number of ranks.
+    convergence_tolerance : float
+        If given, the inference stops before number_iterations when the exponential moving average of the loss has not
+        improved by this relative amount for convergence_patience consecutive iterations. The criterion is checked every
+        loss_flush_interval iterations (by default DEFAULT_CONVERGENCE_CHECK_INTERVAL), when the loss history is
+        transferred to the host. The additional transfers of the checkpoints do not change the stopping iteration. The number of performed iterations is stored in
+        joint_model.diagnostics["stopping iteration"].
+    convergence_patience : int
+    ema_decay : float
+        Decay of the exponential moving average of the loss.
+    scheduler : str or torch.optim.lr_scheduler class
+        Learning rate scheduler of the optimizers (see brancher.optimizers.ProbabilisticOptimizer).
+    scheduler_params : dict
+        Keyword arguments of the scheduler.
+    accumulation_steps : int
+        Number of iterations whose gradients are averaged in each step of the optimizers. Each iteration evaluates the
+        loss with number_samples samples, so the effective number of samples per step is
+        number_samples*accumulation_steps.
+    distributed_samples : bool
+        If True, the inference runs in all the ranks of the initialized torch.distributed process group. Each rank draws
+        its share of the number_samples samples, the gradients and the loss are all-reduced before each step of the
+        optimizers and the parameters are broadcasted from rank 0 at the beginning, so that they are identical in all
+        ranks. Only rank 0 writes checkpoints.
+
+    If some observed variable of the joint model is sharded (RandomVariable.observe(data, sharded=True)), the inference
+    also runs in all the ranks of the process group. All the ranks draw the same number_samples samples of the latent
+    variables, each rank evaluates the likelihood of its shard of the data and the partial losses and gradients are
+    summed across ranks, so that the optimizers follow the gradient of the loss of the full data. The factors that do
+    not depend on the sharded data (e.g. the prior) are divided by the number of ranks. The inference methods that do
+    not support sharded observations (InferenceMethod.supports_sharded_data) raise an error.
     """
     if not inference_method:
         warnings.warn("The inference method was not specified, using the default reverse KL variational inference")
@@ -72,44 +264,173 @@ def perform_inference(joint_model, number_iterations, number_samples = 1,
                 except AttributeError:
                     sampler_model = None
 
-    joint_model.update_observed_submodel()
-
     def append_prob_optimizer(model, optimizer, **opt_params):
-        prob_opt = ProbabilisticOptimizer(model, optimizer, **opt_params) # TODO: this should be better!!! handling models with no params
+        prob_opt = ProbabilisticOptimizer(model, optimizer, scheduler=scheduler, scheduler_params=scheduler_params,
+                                          accumulation_steps=accumulation_steps, **opt_params) # TODO: this should be better!!! handling models with no params
         if prob_opt.optimizer:
             optimizers_list.append(prob_opt)
 
     optimizers_list = []
-    append_prob_optimizer(posterior_model, optimizer, **opt_params)
+    if inference_method.learnable_posterior:
+        append_prob_optimizer(posterior_model, optimizer, **opt_params)
     if inference_method.learnable_model:
         append_prob_optimizer(joint_model, optimizer, **opt_params)
     if inference_method.learnable_sampler:
         append_prob_optimizer(sampler_model, optimizer, **opt_params)
 
     loss_list = []
+    loss_buffer = []
+    if convergence_tolerance is not None:
+        convergence_monitor = ConvergenceMonitor(convergence_tolerance, convergence_patience, ema_decay)
+        if not loss_flush_interval:
+            loss_flush_interval = DEFAULT_CONVERGENCE_CHECK_INTERVAL
+    else:
+        convergence_monitor = None
+
+    def flush_loss_buffer():
+        if not loss_buffer:
+            return
+        losses = torch.cat(loss_buffer).cpu().numpy()
+        loss_buffer.clear()
+        number_errors = int(np.sum(~np.isfinite(losses)))
+        if number_errors:
+            warnings.warn("Numerical error in {} iterations, the gradients of those samples were skipped".format(number_errors))
+        loss_list.extend(losses)
+        joint_model.diagnostics.update({"loss curve": np.array(loss_list)})
+        if convergence_monitor is not None:
+            convergence_monitor.update(losses)
+
+    def is_check_iteration(iteration):
+        """
+        The convergence is only checked every loss_flush_interval iterations, so that the stopping iteration does not
+        depend on the additional flushes of the checkpoints.
+        """
+        return bool(loss_flush_interval) and iteration % loss_flush_interval == 0
 
     inference_method.check_model_compatibility(joint_model, posterior_model, sampler_model)
 
-    for iteration in tqdm(range(number_iterations)):
-        loss = inference_method.compute_loss(joint_model, posterior_model, sampler_model, number_samples)
-
-        if torch.isfinite(loss.detach()).all().item(): #np.isfinite(loss.detach().numpy()).all(): #TODO: numpy()
-            [opt.zero_grad() for opt in optimizers_list]
-            loss.backward()
-            inference_method.correct_gradient(joint_model, posterior_model, sampler_model, number_samples)
-            optimizers_list[0].update()
-            if iteration > pretraining_iterations:
-                [opt.update() for opt in optimizers_list[1:]]
-            loss_list.append(loss.cpu().detach().numpy().flatten())
-        else:
-            warnings.warn("Numerical error, skipping sample")
-        loss_list.append(loss.cpu().detach().numpy())
+    posterior_locations = None # Particles updated by the inference method, they are not saved by the optimizers
+    if not inference_method.learnable_posterior:
+        if isinstance(posterior_model, ParticleSet):
+            posterior_locations = posterior_model.get_locations()
+        elif checkpoint_dir or resume_from:
+            raise ValueError("The checkpoints of inference methods that update the posterior model themselves require "
+                             "a ParticleSet as posterior model")
+
+    first_iteration = 0
+    if resume_from:
+        checkpoint = load_checkpoint(resume_from)
+        if len(checkpoint["optimizers"]) != len(optimizers_list):
+            raise ValueError("The checkpoint does not match the models of the inference")
+        [opt.load_state_dict(state) for opt, state in zip(optimizers_list, checkpoint["optimizers"])]
+        loss_list.extend(checkpoint["loss curve"])
+        first_iteration = checkpoint["iteration"]
+        set_rng_state(checkpoint["rng"])
+        if convergence_monitor is not None and "convergence" in checkpoint:
+            convergence_monitor.load_state_dict(checkpoint["convergence"])
+        if "inference method" in checkpoint:
+            inference_method.load_state_dict(checkpoint["inference method"])
+        if posterior_locations is not None:
+            saved_locations = checkpoint.get("posterior locations", [])
+            if len(saved_locations) != len(posterior_locations):
+                raise ValueError("The checkpoint does not match the posterior model of the inference")
+            with torch.no_grad():
+                [location.copy_(saved_location) for location, saved_location in zip(posterior_locations, saved_locations)]
+
+    sharded_data = joint_model.has_sharded_observations
+    is_distributed = distributed_samples or sharded_data
+    if is_distributed and not distributed.is_distributed():
+        raise ValueError("The distributed inference requires an initialized torch.distributed process group")
+    if distributed_samples and sharded_data:
+        raise ValueError("The samples cannot be distributed across ranks when the observed data is sharded")
+    if sharded_data and not inference_method.supports_sharded_data:
+        raise ValueError("The inference method {} does not support sharded observations".format(type(inference_method).__name__))
+    if distributed_samples and not inference_method.learnable_posterior:
+        raise ValueError("The samples cannot be distributed across ranks when the inference method updates the "
+                         "posterior model itself")
+    rank_rng_states = checkpoint.get("rank rng", None) if resume_from and is_distributed else None
+    if rank_rng_states is not None and len(rank_rng_states) != distributed.get_world_size():
+        warnings.warn("The checkpoint was saved with {} ranks, the random number generators are reinitialized and the "
+                      "resumed run does not reproduce the interrupted one".format(len(rank_rng_states)))
+        rank_rng_states = None
+    if distributed_samples:
+        local_number_samples = distributed.split_number_samples(number_samples)
+        sample_weight = local_number_samples/number_samples
+        distributed.broadcast_parameters(optimizers_list)
+        if rank_rng_states is None:
+            distributed.offset_rng_state()
+    else:
+        local_number_samples = number_samples
+        sample_weight = 1.
+    if sharded_data:
+        distributed.broadcast_parameters(optimizers_list, extra_parameters=posterior_locations)
+        if rank_rng_states is None:
+            distributed.synchronize_rng_state()
+    if rank_rng_states is not None:
+        set_rng_state(rank_rng_states[distributed.get_rank()])
+    is_checkpoint_writer = distributed.get_rank() == 0 if is_distributed else True
+
+    def write_checkpoint():
+        rank_rng_states = distributed.all_gather_object(get_rng_state()) if is_distributed else None
+        if is_checkpoint_writer:
+            save_checkpoint(checkpoint_dir, completed_iterations, optimizers_list, loss_list, convergence_monitor,
+                            inference_method, posterior_locations, rank_rng_states)
+
+    closure_losses = []
+    closure_conditions = []
+
+    def closure():
+        [opt.zero_grad() for opt in optimizers_list]
+        loss = inference_method.compute_loss(joint_model, posterior_model, sampler_model, local_number_samples)
+        loss.backward()
+        if is_distributed: # The gradient corrections (e.g. SVGD) are applied to the gradients of the full loss
+            loss = distributed.all_reduce_gradients(optimizers_list, loss, sample_weight,
+                                                    extra_parameters=posterior_locations)
+        inference_method.correct_gradient(joint_model, posterior_model, sampler_model, local_number_samples)
+        is_finite = torch.isfinite(loss.detach()).all()
+        [opt.mask_gradients(is_finite) for opt in optimizers_list]
+        closure_losses.append(loss)
+        closure_conditions.append(is_finite)
+        return loss
+
+    completed_iterations = first_iteration
+    is_converged = convergence_monitor is not None and convergence_monitor.converged and \
+                   is_check_iteration(first_iteration)
+    last_iteration = first_iteration if is_converged else number_iterations
+    for iteration in tqdm(range(first_iteration, last_iteration)):
+        active_optimizers = optimizers_list if iteration > pretraining_iterations else optimizers_list[:1]
+        closure_losses.clear()
+        closure_conditions.clear()
+        [opt.update(closure=closure) for opt in active_optimizers if opt.requires_closure]
+        if not closure_losses:
+            closure()
+        loss = closure_losses[0]
+        [opt.update(loss, condition=closure_conditions[0]) for opt in active_optimizers if not opt.requires_closure]
+        inference_method.update_posterior(joint_model, posterior_model)
+        loss_buffer.append(loss.detach().flatten())
+        completed_iterations = iteration + 1
+        if is_check_iteration(completed_iterations):
+            flush_loss_buffer()
+            is_converged = convergence_monitor is not None and convergence_monitor.converged
+        if checkpoint_dir and checkpoint_interval and completed_iterations % checkpoint_interval == 0:
+            flush_loss_buffer()
+            write_checkpoint()
+        if is_converged:
+            break
+    flush_loss_buffer()
+    if checkpoint_dir:
+        write_checkpoint()
     joint_model.diagnostics.update({"loss curve": np.array(loss_list)})
+    if convergence_monitor is not None:
+        joint_model.diagnostics.update({"stopping iteration": completed_iterations,
+                                        "converged": convergence_monitor.converged})
 
     inference_method.post_process(joint_model) #TODO: this could be implemented with a with block
 
 
 class InferenceMethod(ABC):
+    learnable_posterior = True # If False, the method updates the posterior model itself in update_posterior
+    supports_sharded_data = True # If False, the method cannot be used when the observed data is sharded
 
     @abstractmethod
     def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
@@ -123,20 +444,54 @@ class InferenceMethod(ABC):
     def post_process(self, joint_model):
         pass
 
+    def update_posterior(self, joint_model, posterior_model):
+        pass
+
+    def state_dict(self):
+        """
+        Method. It returns the state of the method that is saved in the checkpoints of perform_inference.
+        """
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
 
 class ReverseKL(InferenceMethod):
 
-    def __init__(self):
+    def __init__(self, evidence_method="ELBO", number_importance_samples=10, score_function_baseline="leave_one_out",
+                 analytic_kl=False):
+        """
+        Args:
+            evidence_method: String. Bound of the log evidence that is maximized, "ELBO" or "IWAE" (see
+            brancher.ProbabilisticModel.estimate_log_model_evidence).
+
+            number_importance_samples: Int. Number of importance samples per sample of the IWAE bound.
+
+            score_function_baseline: String. Control variate of the score function gradients of the discrete variables
+            of the posterior model.
+
+            analytic_kl: Bool. If True, the ELBO uses the closed-form KL divergences of the latent variables when they
+            are available.
+        """
         self.learnable_model = True
         self.needs_sampler = False
         self.learnable_sampler = False
+        self.evidence_method = evidence_method
+        self.number_importance_samples = number_importance_samples
+        self.score_function_baseline = score_function_baseline
+        self.analytic_kl = analytic_kl
 
     def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
         pass #TODO: Check differentiability of the model
 
     def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
         loss = -joint_model.estimate_log_model_evidence(number_samples=number_samples,
-                                                        method="ELBO", input_values=input_values, for_gradient=True)
+                                                        method=self.evidence_method, input_values=input_values,
+                                                        for_gradient=True,
+                                                        number_importance_samples=self.number_importance_samples,
+                                                        score_function_baseline=self.score_function_baseline,
+                                                        analytic_kl=self.analytic_kl)
         return loss
 
     def correct_gradient(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
@@ -151,12 +506,22 @@ class WassersteinVariationalGradientDescent(InferenceMethod):
                  cost_function=None,
                  deviation_statistics=None,
                  biased=False,
-                 number_post_samples=8000):
+                 number_post_samples=8000,
+                 number_workers=1):
+        """
+        Args:
+            number_workers: Int. Number of threads that evaluate the losses of the samplers in parallel. By default the
+            samplers are evaluated sequentially. The order in which the threads draw random numbers is not fixed, so
+            the run is only reproducible with number_workers=1.
+        """
         self.learnable_model = False #TODO: to implement later
         self.needs_sampler = True
         self.learnable_sampler = True
         self.biased = biased
         self.number_post_samples = number_post_samples
+        self.supports_sharded_data = False # The importance weights of the particle losses are not sharded
+        self.number_workers = number_workers
+        self._executor = None
         if cost_function:
             self.cost_function = cost_function
         else:
@@ -190,38 +555,57 @@ class WassersteinVariationalGradientDescent(InferenceMethod):
         # TODO: Check differentiability of the model
         # TODO: check particles
 
+    def _map_samplers(self, function, *iterables):
+        """
+        Method. It applies the function to the samplers, sequentially or in a thread pool of number_workers threads.
+        The pool is created on first use and shut down in post_process, at the end of the inference. The evaluation of
+        the models is thread-safe since each call uses its own brancher.EvaluationContext and the tensor operations
+        release the GIL.
+        """
+        if self.number_workers <= 1:
+            return list(map(function, *iterables))
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.number_workers)
+            weakref.finalize(self, self._executor.shutdown, wait=False) # If the inference is interrupted
+        return list(self._executor.map(function, *iterables))
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
     def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
-        sampler_loss = sum([-joint_model.estimate_log_model_evidence(number_samples=number_samples, posterior_model=subsampler,
-                                                                      method="ELBO", input_values=input_values, for_gradient=True)
-                             for subsampler in sampler_model])
-        particle_loss = self.get_particle_loss(joint_model, posterior_model, sampler_model, number_samples,
-                                               input_values)
-        return sampler_loss + particle_loss
+        def get_sampler_loss(sampler, particle):
+            ELBO = joint_model.estimate_log_model_evidence(number_samples=number_samples, posterior_model=sampler,
+                                                           method="ELBO", input_values=input_values, for_gradient=True)
+            return -ELBO + self._get_single_particle_loss(joint_model, particle, sampler, number_samples, input_values)
+
+        return sum(self._map_samplers(get_sampler_loss, sampler_model, posterior_model))
 
     def get_particle_loss(self, joint_model, particle_list, sampler_model, number_samples, input_values):
-        samples_list = [sampler._get_sample(number_samples, input_values=input_values)
-                         for sampler in sampler_model]
+        return sum(self._map_samplers(lambda particle, sampler: self._get_single_particle_loss(joint_model, particle,
+                                                                                                 sampler, number_samples,
+                                                                                                 input_values),
+                                      particle_list, sampler_model))
+
+    def _get_single_particle_loss(self, joint_model, particle, sampler, number_samples, input_values):
+        samples = sampler._get_sample(number_samples, input_values=input_values)
         if self.biased:
-            importance_weights = [1./number_samples for _ in sampler_model]
+            importance_weights = 1./number_samples
         else:
-            importance_weights = [joint_model.get_importance_weights(q_samples=samples,
-                                                                       q_model=sampler,
-                                                                       for_gradient=False).flatten()
-                                  for samples, sampler in zip(samples_list, sampler_model)]
-        reassigned_samples_list = [reassign_samples(samples, source_model=sampler, target_model=particle)
-                                   for samples, sampler, particle in zip(samples_list, sampler_model, particle_list)]
-        pair_list = [zip_dict(particle._get_sample(1), samples)
-                     for particle, samples in zip(particle_list, reassigned_samples_list)]
-
-        particle_loss = sum([torch.sum(to_tensor(w)*self.deviation_statistics([self.cost_function(value_pair[0], value_pair[1].detach().numpy()) #TODO: numpy()
-                                                                for var, value_pair in particle.items()]))
-                             for particle, w in zip(pair_list, importance_weights)])
-        return particle_loss
+            importance_weights = joint_model.get_importance_weights(q_samples=samples,
+                                                                     q_model=sampler,
+                                                                     for_gradient=False).flatten()
+        reassigned_samples = reassign_samples(samples, source_model=sampler, target_model=particle)
+        pairs = zip_dict(particle._get_sample(1), reassigned_samples)
+        return torch.sum(importance_weights*self.deviation_statistics([self.cost_function(value_pair[0], value_pair[1].detach())
+                                                                       for var, value_pair in pairs.items()]))
 
     def correct_gradient(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
         pass
 
     def post_process(self, joint_model):
+        self._shutdown_executor()
         sample_list = [sampler._get_sample(self.number_post_samples)
                         for sampler in self.sampler_model]
         log_weights = []
@@ -232,10 +616,7 @@ class WassersteinVariationalGradientDescent(InferenceMethod):
                                                          for_gradient=False,
                                                          give_normalization=True)
             log_weights.append(np.log(a) + logZ)
-        log_weights = np.array(log_weights)
-        alpha = np.max(log_weights)
-        un_weights = np.exp(log_weights - alpha)
-        self.weights = un_weights/np.sum(un_weights)
+        self.weights = torch.softmax(torch.stack(log_weights).double(), dim=0).cpu().numpy()
 
 
 class MAP(InferenceMethod):
@@ -254,7 +635,8 @@ class MAP(InferenceMethod):
         variable_values = reassign_samples(posterior_model._get_sample(1), source_model=posterior_model,
                                            target_model=joint_model)
         variable_values.update(empirical_samples)
-        loss = -joint_model.calculate_log_probability(variable_values, for_gradient=True)
+        loss = -joint_model.calculate_log_probability(variable_values, for_gradient=True,
+                                                      sharded=joint_model.has_sharded_observations)
         return loss
 
     def correct_gradient(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
@@ -270,8 +652,7 @@ class SteinVariationalGradientDescent(InferenceMethod): #TODO: work in progress
         self.learnable_model = False  # TODO: to implement later
         self.needs_sampler = False
         self.learnable_sampler = False
-        self.deviation = lambda x, y: np.sum(((to_tensor(x) - to_tensor(y))**2).detach().numpy())
-        self.kernel = lambda d, bw: np.exp(-d/(2*bw))
+        self.kernel = lambda d, bw: torch.exp(-d/(2*bw))
         self.bandwidth = 0.01
 
     def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
@@ -281,39 +662,263 @@ class SteinVariationalGradientDescent(InferenceMethod): #TODO: work in progress
 
     def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
         empirical_samples = joint_model.observed_submodel._get_sample(1, observed=True)
+        if isinstance(posterior_model, ParticleSet):
+            particle_samples = reassign_samples(posterior_model._get_sample(len(posterior_model)),
+                                                source_model=posterior_model, target_model=joint_model)
+            particle_samples.update(empirical_samples)
+            return -torch.sum(joint_model.calculate_log_probability(particle_samples, for_gradient=True,
+                                                                    sharded=joint_model.has_sharded_observations))
         particle_samples = [reassign_samples(particle._get_sample(1), source_model=particle, target_model=joint_model)
                             for particle in posterior_model]
         [sample.update(empirical_samples) for sample in particle_samples]
-        loss = sum([-joint_model.calculate_log_probability(sample, for_gradient=True)
+        loss = sum([-joint_model.calculate_log_probability(sample, for_gradient=True,
+                                                           sharded=joint_model.has_sharded_observations)
                     for sample in particle_samples])
         return loss
 
+    @staticmethod
+    def _get_particle_parameters(posterior_model):
+        """
+        Method. It returns the learnable parameters of each particle, sorted by the name of their variables so that
+        the parameters of the same variable are aligned across particles.
+        """
+        return [[variable.value for variable in sorted(particle._flatten(), key=lambda v: v.name)
+                 if isinstance(variable, DeterministicVariable) and variable.learnable]
+                for particle in posterior_model]
+
+    def _stack_particles(self, posterior_model):
+        """
+        Method. It returns the locations of the particles and the gradients of the loss with respect to them as two
+        (number_particles, dimension) tensors.
+        """
+        def stack(tensors_list):
+            return torch.stack([torch.cat([tensor.reshape(-1) for tensor in tensors]) for tensors in tensors_list])
+
+        def get_gradient(parameter):
+            return parameter.grad if parameter.grad is not None else torch.zeros_like(parameter)
+
+        if isinstance(posterior_model, ParticleSet):
+            parameters = posterior_model.get_locations()
+            locations = torch.cat([parameter.detach().reshape(len(posterior_model), -1) for parameter in parameters], dim=1)
+            gradients = torch.cat([get_gradient(parameter).reshape(len(posterior_model), -1) for parameter in parameters], dim=1)
+            return locations, gradients
+        parameters = self._get_particle_parameters(posterior_model)
+        locations = stack([[parameter.detach() for parameter in particle_parameters] for particle_parameters in parameters])
+        gradients = stack([[get_gradient(parameter) for parameter in particle_parameters] for particle_parameters in parameters])
+        return locations, gradients
+
+    def _set_particle_gradients(self, posterior_model, gradients):
+        """
+        Method. It assigns the rows of the (number_particles, dimension) gradient tensor to the particles.
+        """
+        if isinstance(posterior_model, ParticleSet):
+            parameters_list = [posterior_model.get_locations()]
+            gradients_list = [gradients]
+            get_size = lambda parameter: parameter[0].numel()
+        else:
+            parameters_list = self._get_particle_parameters(posterior_model)
+            gradients_list = gradients
+            get_size = lambda parameter: parameter.numel()
+        for parameters, gradient in zip(parameters_list, gradients_list):
+            offset = 0
+            for parameter in parameters:
+                size = get_size(parameter)
+                parameter.grad = gradient[..., offset:offset + size].reshape(parameter.shape).clone()
+                offset += size
+
+    def correct_gradient(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
+        """
+        Method. It replaces the gradients of the particles with the Stein variational gradient: each particle moves
+        along the kernel-weighted gradients of all the particles and is repelled by the nearby particles.
+        """
+        with torch.no_grad():
+            locations, gradients = self._stack_particles(posterior_model)
+            squared_distances = torch.cdist(locations, locations)**2
+            self.update_bandwidth(posterior_model, squared_distances=squared_distances)
+            kernel_matrix = self.kernel(squared_distances, self.bandwidth)
+            repulsion = (torch.matmul(kernel_matrix, locations) - kernel_matrix.sum(dim=1, keepdim=True)*locations)/self.bandwidth
+            self._set_particle_gradients(posterior_model, torch.matmul(kernel_matrix, gradients) + repulsion)
+
+    def update_bandwidth(self, posterior_model, squared_distances=None):
+        """
+        Method. It sets the bandwidth of the kernel with the median heuristic.
+        """
+        number_particles = len(posterior_model)
+        if number_particles < 2:
+            return
+        if squared_distances is None:
+            with torch.no_grad():
+                locations, _ = self._stack_particles(posterior_model)
+                squared_distances = torch.cdist(locations, locations)**2
+        off_diagonal = ~torch.eye(number_particles, dtype=torch.bool, device=squared_distances.device)
+        median_distance = torch.quantile(squared_distances[off_diagonal].sqrt(), 0.5)
+        self.bandwidth = 2*median_distance**2/np.log(number_particles)
+
+    def post_process(self, joint_model):
+        pass
+
+
+class StochasticGradientMCMC(InferenceMethod):
+    """
+    Base class of the stochastic gradient Markov chain Monte Carlo methods. The posterior model has to be a
+    brancher.ParticleSet: each particle is a chain and all the chains are updated in batch with the gradient of the
+    (minibatch) log probability of the joint model. The method updates the chains itself, so no optimizer is created
+    for the posterior model and the number_samples argument of perform_inference is ignored.
+
+    When the observed data is subsampled with EmpiricalVariables (e.g. indexed by RandomIndices), the log likelihood
+    of the minibatch is scaled by dataset_size/batch_size so that the gradient is an unbiased estimate of the gradient
+    of the log posterior of the full data.
+
+    After burn_in updates, the state of the chains is stored every thinning updates in a preallocated buffer that keeps
+    the last buffer_size states (see get_samples).
+    """
+    def __init__(self, step_size, dataset_size=None, burn_in=0, thinning=1, buffer_size=1000):
+        self.learnable_model = False
+        self.needs_sampler = False
+        self.learnable_sampler = False
+        self.learnable_posterior = False
+        self.step_size = step_size
+        self.dataset_size = dataset_size
+        self.burn_in = burn_in
+        self.thinning = thinning
+        self.buffer_size = buffer_size
+        self.number_updates = 0
+        self.number_stored_samples = 0
+        self.sample_buffer = None
+        self.sample_variables = None
+
+    def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
+        if not isinstance(posterior_model, ParticleSet):
+            raise ValueError("The stochastic gradient MCMC methods require a ParticleSet as posterior model")
+        self.sample_variables = list(posterior_model.variables)
+
+    def _get_likelihood_scale(self, joint_model):
+        if self.dataset_size is None:
+            return 1.
+        variables = list(joint_model._flatten())
+        for var in joint_model._get_log_probability_factors():
+            if var.has_random_dataset:
+                variables.extend([var.dataset] + list(var.dataset.ancestors))
+        batch_sizes = set([var.batch_size for var in variables if isinstance(var, EmpiricalVariable)])
+        if len(batch_sizes) != 1:
+            raise ValueError("The dataset size scaling requires the observed data to be subsampled with a single batch size")
+        return self.dataset_size/batch_sizes.pop()
+
+    def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
+        empirical_samples = joint_model.observed_submodel._get_sample(1, observed=True)
+        chain_samples = reassign_samples(posterior_model._get_sample(len(posterior_model)),
+                                         source_model=posterior_model, target_model=joint_model)
+        chain_samples.update(empirical_samples)
+        likelihood_scale = self._get_likelihood_scale(joint_model)
+        factors = joint_model._get_log_probability_factors()
+        shard_weights = joint_model._get_shard_weights() if joint_model.has_sharded_observations else [1.]*len(factors)
+        log_probability = sum([weight*(likelihood_scale if var.is_observed else 1.)*var._calculate_log_probability_factor(chain_samples)
+                               for var, weight in zip(factors, shard_weights)])
+        return -torch.sum(log_probability)
+
     def correct_gradient(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
-        self.update_bandwidth(posterior_model)
-        gradients = [[variable.value.grad for variable in particle.flatten()] for particle in posterior_model]
-        kernel_matrix = [[self.kernel(sum([self.deviation(variable1.value, variable2.value)
-                                          for variable1, variable2 in zip(particle1.flatten(), particle2.flatten())]),
-                                      bw=self.bandwidth)
-                          for particle1 in posterior_model] for particle2 in posterior_model]
-        interaction_matrix = [[[-(variable1.value - variable2.value)*kernel_matrix[particle_index1][particle_index2]/self.bandwidth
-                               for variable1, variable2 in zip(particle1.flatten(), particle2.flatten())]
-                              for particle_index1, particle1 in enumerate(posterior_model)]
-                              for particle_index2, particle2 in enumerate(posterior_model)]
-        for particle_index, particle in enumerate(posterior_model):
-            for variable_index, variable in enumerate(particle.flatten()):
-                variable.value.grad = sum([kernel_matrix[particle_index][other_index]*other_gradient[variable_index] + interaction_matrix[particle_index][other_index][variable_index]
-                                           for other_index, other_gradient in enumerate(gradients)])
-
-    def update_bandwidth(self, posterior_model):
-        distances = [np.sqrt(sum([self.deviation(variable1.value, variable2.value)
-                                  for variable1, variable2 in zip(particle1.flatten(), particle2.flatten())]))
-                     for particle1 in posterior_model
-                     for particle2 in posterior_model
-                     if particle1 is not particle2]
-        bw = 2*np.median(distances)**2/np.log(len(posterior_model))
-        self.bandwidth = bw
+        pass
+
+    @abstractmethod
+    def _update_location(self, name, location, gradient, condition):
+        """
+        Abstract method. It updates the location of the chains in place. The update is skipped where the boolean
+        condition tensor is False.
+        """
+        pass
+
+    def update_posterior(self, joint_model, posterior_model):
+        with torch.no_grad():
+            locations = [var.value for var in posterior_model.variables]
+            gradients = [location.grad if location.grad is not None else torch.zeros_like(location)
+                         for location in locations]
+            # Iterations with non-finite gradients leave the chains unchanged, the check stays on the device
+            is_finite = torch.stack([torch.isfinite(gradient).all() for gradient in gradients]).all()
+            for var, location, gradient in zip(posterior_model.variables, locations, gradients):
+                self._update_location(var.name, location, torch.where(is_finite, gradient, torch.zeros_like(gradient)),
+                                      is_finite)
+                location.grad = None
+        self.number_updates += 1
+        if self.number_updates > self.burn_in and (self.number_updates - self.burn_in) % self.thinning == 0:
+            self._store_sample(posterior_model)
+
+    def _store_sample(self, posterior_model):
+        locations = posterior_model.get_locations()
+        if self.sample_buffer is None:
+            self.sample_buffer = [torch.empty((self.buffer_size,) + tuple(location.shape),
+                                              dtype=location.dtype, device=location.device)
+                                  for location in locations]
+        index = self.number_stored_samples % self.buffer_size
+        for buffer, location in zip(self.sample_buffer, locations):
+            buffer[index].copy_(location.detach())
+        self.number_stored_samples += 1
+
+    def get_samples(self):
+        """
+        Method. It returns the stored states of all the chains, from the oldest to the newest.
+
+        Args: None.
+
+        Returns:
+            Dictionary(brancher.Variable: torch.Tensor). The samples of each variable of the posterior model, with
+            shape (number_stored_states*number_chains, 1, ...).
+        """
+        if not self.number_stored_samples:
+            return {}
+        number_states = min(self.number_stored_samples, self.buffer_size)
+        first_index = self.number_stored_samples % self.buffer_size if self.number_stored_samples > self.buffer_size else 0
+        order = (torch.arange(number_states) + first_index) % self.buffer_size
+        return {var: buffer[order.to(buffer.device)].reshape((-1,) + tuple(buffer.shape[2:]))
+                for var, buffer in zip(self.sample_variables, self.sample_buffer)}
+
+    def state_dict(self):
+        return {"number_updates": self.number_updates, "number_stored_samples": self.number_stored_samples,
+                "sample_buffer": self.sample_buffer}
+
+    def load_state_dict(self, state_dict):
+        self.number_updates = state_dict["number_updates"]
+        self.number_stored_samples = state_dict["number_stored_samples"]
+        self.sample_buffer = state_dict["sample_buffer"]
 
     def post_process(self, joint_model):
         pass
 
 
+class StochasticGradientLangevinDynamics(StochasticGradientMCMC):
+    """
+    Stochastic gradient Langevin dynamics: each chain follows a gradient step of size step_size/2 on the log
+    probability perturbed with Gaussian noise of variance step_size.
+    """
+
+    def _update_location(self, name, location, gradient, condition):
+        step = -0.5*self.step_size*gradient + np.sqrt(self.step_size)*torch.randn_like(location)
+        location.add_(torch.where(condition, step, torch.zeros_like(step)))
+
+
+class StochasticGradientHamiltonianMonteCarlo(StochasticGradientMCMC):
+    """
+    Stochastic gradient Hamiltonian Monte Carlo: each chain has a momentum that is decayed by the friction, pushed by
+    the gradient of the log probability and perturbed with Gaussian noise of variance 2*friction*step_size.
+    """
+    def __init__(self, step_size, friction=0.1, dataset_size=None, burn_in=0, thinning=1, buffer_size=1000):
+        super().__init__(step_size, dataset_size=dataset_size, burn_in=burn_in, thinning=thinning,
+                         buffer_size=buffer_size)
+        self.friction = friction
+        self.momenta = {} # Momenta of the chains by variable name
+
+    def _update_location(self, name, location, gradient, condition):
+        momentum = self.momenta.get(name, None)
+        if momentum is None:
+            momentum = torch.zeros_like(location)
+            self.momenta[name] = momentum
+        updated_momentum = (1 - self.friction)*momentum - self.step_size*gradient + \
+                           np.sqrt(2*self.friction*self.step_size)*torch.randn_like(location)
+        momentum.copy_(torch.where(condition, updated_momentum, momentum))
+        location.add_(torch.where(condition, momentum, torch.zeros_like(momentum)))
+
+    def state_dict(self):
+        return {**super().state_dict(), "momenta": self.momenta}
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        self.momenta = dict(state_dict["momenta"])
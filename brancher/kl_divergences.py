@@ -0,0 +1,94 @@
+"""
+KL divergences
+---------
+Registry of closed-form KL divergences between the distribution of a random variable of the posterior model (q) and
+the distribution of the matching random variable of the joint model (p). The ELBO uses them, when requested, instead
+of the Monte Carlo estimate of the log probability ratio of the pair.
+"""
+from torch import distributions as torch_distributions
+
+from brancher import distributions
+from brancher.utilities import broadcast_and_squeeze_mixed
+from brancher.utilities import partial_broadcast
+from brancher.utilities import sum_data_dimensions
+
+_KL_REGISTRY = {}
+
+
+def register_kl(q_distribution_class, p_distribution_class):
+    """
+    Decorator. It registers a function that computes the KL divergence KL(q || p) between two distributions of the
+    given brancher classes. The function receives the parameters of q and p, as computed by the links of the
+    variables, and it returns a tensor with shape (number_samples, number_datapoints).
+    """
+    def decorator(kl_function):
+        _KL_REGISTRY[(q_distribution_class, p_distribution_class)] = kl_function
+        return kl_function
+    return decorator
+
+
+def has_analytic_kl(q_distribution, p_distribution):
+    return (type(q_distribution), type(p_distribution)) in _KL_REGISTRY
+
+
+def calculate_kl(q_distribution, q_parameters, p_distribution, p_parameters):
+    """
+    It returns the closed-form KL divergence KL(q || p) between two brancher distributions.
+
+    Args:
+        q_distribution: brancher.Distribution.
+
+        q_parameters: Dictionary(str: torch.Tensor). Parameters of q.
+
+        p_distribution: brancher.Distribution.
+
+        p_parameters: Dictionary(str: torch.Tensor). Parameters of p.
+
+    Returns:
+        torch.Tensor. The KL divergence, with shape (number_samples, number_datapoints).
+    """
+    kl_function = _KL_REGISTRY[(type(q_distribution), type(p_distribution))]
+    return kl_function(q_parameters, p_parameters)
+
+
+def _univariate_kl(get_torch_distribution):
+    """
+    It returns a KL function for univariate distributions. The parameters are broadcasted as in the evaluation of the
+    log probability and the KL divergence is summed over the data dimensions.
+    """
+    def kl_function(q_parameters, p_parameters):
+        parameters = broadcast_and_squeeze_mixed((), {**{("q", name): value for name, value in q_parameters.items()},
+                                                      **{("p", name): value for name, value in p_parameters.items()}})
+        q = get_torch_distribution({name: value for (model, name), value in parameters.items() if model == "q"})
+        p = get_torch_distribution({name: value for (model, name), value in parameters.items() if model == "p"})
+        return sum_data_dimensions(torch_distributions.kl_divergence(q, p))
+    return kl_function
+
+
+register_kl(distributions.NormalDistribution, distributions.NormalDistribution)(
+    _univariate_kl(lambda parameters: torch_distributions.normal.Normal(loc=parameters["loc"],
+                                                                         scale=parameters["scale"])))
+
+register_kl(distributions.LogNormalDistribution, distributions.LogNormalDistribution)(
+    _univariate_kl(lambda parameters: torch_distributions.log_normal.LogNormal(loc=parameters["loc"],
+                                                                                scale=parameters["scale"])))
+
+# The parameters are mapped to the concentrations as in brancher.distributions.BetaDistribution
+register_kl(distributions.BetaDistribution, distributions.BetaDistribution)(
+    _univariate_kl(lambda parameters: torch_distributions.beta.Beta(concentration0=parameters["alpha"],
+                                                                     concentration1=parameters["beta"])))
+
+
+@register_kl(distributions.CategoricalDistribution, distributions.CategoricalDistribution)
+def _categorical_kl(q_parameters, p_parameters):
+    q_name = "p" if "p" in q_parameters else "softmax_p"
+    p_name = "p" if "p" in p_parameters else "softmax_p"
+    q_vector, p_vector = partial_broadcast(q_parameters[q_name], p_parameters[p_name])
+    shape = tuple(q_vector.shape[:2]) + (-1,)
+
+    def get_categorical(name, vector):
+        if name == "p":
+            return torch_distributions.categorical.Categorical(probs=vector.reshape(shape))
+        return torch_distributions.categorical.Categorical(logits=vector.reshape(shape))
+
+    return torch_distributions.kl_divergence(get_categorical(q_name, q_vector), get_categorical(p_name, p_vector))
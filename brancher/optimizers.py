@@ -6,6 +6,7 @@ Module description
 from abc import ABC, abstractmethod
 from collections.abc import Iterable
 import copy
+import inspect
 
 import torch
 
@@ -23,12 +24,30 @@ class ProbabilisticOptimizer(ABC):
     ----------
     optimizer : chainer optimizer
         Summary
+    scheduler : str or torch.optim.lr_scheduler class
+        Learning rate scheduler. It can be the name of a scheduler in torch.optim.lr_scheduler. The scheduler is stepped
+        after every step of the optimizer.
+    scheduler_params : dict
+        Keyword arguments of the scheduler.
+    accumulation_steps : int
+        Number of calls to update whose gradients are averaged before each step of the optimizer.
     """
-    def __init__(self, model, optimizer='Adam', **kwargs):
+    def __init__(self, model, optimizer='Adam', scheduler=None, scheduler_params=None, accumulation_steps=1, **kwargs):
         assert isinstance(optimizer, str), 'Optimizer should be a name of available pytoch optimizers' #TODO: improve, list optim?
-        self.link_set = set()
+        assert isinstance(accumulation_steps, int) and accumulation_steps >= 1, 'The number of accumulation steps should be a positive integer'
+        self.link_set = {} # Ordered set of links, the order of the parameters is deterministic
         self.module = None
+        self.scheduler = None
+        self.accumulation_steps = accumulation_steps
+        self.accumulated_steps = 0
+        self.accumulated_gradients = None
+        self.accumulated_loss = None
+        self.accumulated_finite_steps = None
         self.setup(model, optimizer, **kwargs) #TODO: add asserts for checking the params dictionary
+        if scheduler and self.optimizer:
+            self.setup_scheduler(scheduler, **(scheduler_params if scheduler_params else {}))
+        if self.requires_closure and accumulation_steps > 1:
+            raise ValueError("Gradient accumulation is not supported by optimizers that re-evaluate the loss, such as LBFGS")
 
     # @staticmethod
     # def _get_default_optimizer(self, **kwargs):
@@ -36,22 +55,34 @@ class ProbabilisticOptimizer(ABC):
     #     return optimizer
 
     def _update_link_set(self, random_variable): #TODO: rename as just variable, because can be deterministic (Parameter)
+        """
+        Method. It adds the links of the variable and all its ancestors to the link set. The graph is traversed in a
+        deterministic order (parents sorted by name), so that the parameters of the optimizer are always in the same
+        order for the same model. It returns the links that were not already in the set.
+        """
         assert isinstance(random_variable, BrancherClass) #TODO: add intuitive error
-        link = random_variable.link if hasattr(random_variable, 'link') else None
-        #if isinstance(link, Link) or isinstance(link, Chain) or isinstance(link, ChainerList):
-        if isinstance(link, (ParameterModule, LinkConstructor)): #TODO: make sure that if user inputs nn.ModuleList, this works
-            self.link_set.add(link)
-
-        vars_attr = 'variables' if isinstance(random_variable, ProbabilisticModel) else 'parents'
-        for var in getattr(random_variable, vars_attr):
-            self._update_link_set(var)
+        new_links = []
+        visited = set()
+        stack = [random_variable]
+        while stack:
+            var = stack.pop()
+            if var in visited:
+                continue
+            visited.add(var)
+            link = var.link if hasattr(var, 'link') else None
+            #if isinstance(link, Link) or isinstance(link, Chain) or isinstance(link, ChainerList):
+            if isinstance(link, (ParameterModule, LinkConstructor)) and link not in self.link_set: #TODO: make sure that if user inputs nn.ModuleList, this works
+                self.link_set[link] = None
+                new_links.append(link)
+            next_vars = var.variables if isinstance(var, ProbabilisticModel) else sorted(var.parents, key=lambda v: v.name)
+            stack.extend(reversed(next_vars))
+        return new_links
 
     def add_variable2module(self, random_variable):
         """
         Summary
         """
-        self._update_link_set(random_variable)
-        for link in self.link_set:
+        for link in self._update_link_set(random_variable):
             if isinstance(link, ParameterModule):
                 self.module.append(link)
             elif isinstance(link, LinkConstructor):
@@ -71,11 +102,157 @@ class ProbabilisticOptimizer(ABC):
             self.optimizer = optimizer_class(self.module.parameters(), **kwargs)
         else:
             self.optimizer = None
+        self.requires_closure = self._requires_closure(self.optimizer)
         self.module.to(device)
 
+    def setup_scheduler(self, scheduler, **kwargs):
+        scheduler_class = getattr(torch.optim.lr_scheduler, scheduler) if isinstance(scheduler, str) else scheduler
+        self.scheduler = scheduler_class(self.optimizer, **kwargs)
+
+    @staticmethod
+    def _requires_closure(optimizer):
+        """
+        Method. It returns True if the step of the optimizer requires a closure that re-evaluates the loss (e.g. LBFGS).
+        """
+        if optimizer is None:
+            return False
+        closure_parameter = inspect.signature(optimizer.step).parameters.get("closure", None)
+        return closure_parameter is not None and closure_parameter.default is inspect.Parameter.empty
+
+    def update(self, loss=None, closure=None, condition=None):
+        """
+        Method. It accumulates the current gradients and, every accumulation_steps calls, it steps the optimizer with the
+        averaged gradients and then the scheduler. The loss is only required by schedulers that monitor a metric such
+        as ReduceLROnPlateau.
+
+        Args:
+            loss: torch.Tensor.
+
+            closure: Callable. A function that zeroes the gradients, re-evaluates the loss, computes its gradients and
+            returns it. It is required by optimizers such as LBFGS and it is passed to the step of the optimizer.
+
+            condition: torch.Tensor. Boolean scalar. If it is False, the gradients of the call are left out of the
+            accumulation (they should be masked, see mask_gradients) and a step without any accumulated gradient leaves
+            the parameters and the state of the optimizer unchanged. The condition is applied on the device, without
+            synchronizing it with the host. The scheduler is stepped in any case.
+
+        Returns:
+            Bool. True if the optimizer was stepped.
+        """
+        if closure is not None:
+            step_loss = self.optimizer.step(closure)
+            self._step_scheduler(loss if loss is not None else step_loss, 1)
+            return True
+        if self.requires_closure:
+            raise ValueError("The optimizer {} requires a closure".format(type(self.optimizer).__name__))
+        if loss is None and isinstance(self.scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+            raise ValueError("The scheduler ReduceLROnPlateau requires the loss")
+        self.accumulated_steps += 1
+        if loss is not None:
+            loss = loss.detach()
+            self.accumulated_loss = loss if self.accumulated_loss is None else self.accumulated_loss + loss
+        if condition is not None:
+            finite_steps = condition.to(dtype=torch.float32)
+            self.accumulated_finite_steps = finite_steps if self.accumulated_finite_steps is None \
+                else self.accumulated_finite_steps + finite_steps
+        if self.accumulation_steps > 1:
+            parameters = [parameter for parameter in self.module.parameters() if parameter.grad is not None]
+            if self.accumulated_gradients is None:
+                self.accumulated_gradients = {parameter: parameter.grad.clone() for parameter in parameters}
+            else:
+                for parameter in parameters:
+                    if parameter in self.accumulated_gradients:
+                        self.accumulated_gradients[parameter].add_(parameter.grad)
+                    else:
+                        self.accumulated_gradients[parameter] = parameter.grad.clone()
+            if self.accumulated_steps < self.accumulation_steps:
+                return False
+            number_steps = self.accumulation_steps if self.accumulated_finite_steps is None \
+                else self.accumulated_finite_steps.clamp(min=1.)
+            for parameter, gradient in self.accumulated_gradients.items():
+                parameter.grad = gradient.div_(number_steps)
+        if self.accumulated_finite_steps is None:
+            self.optimizer.step()
+        else:
+            self._masked_step(self.accumulated_finite_steps > 0)
+        self._step_scheduler(self.accumulated_loss, self.accumulated_steps)
+        self.accumulated_steps = 0
+        self.accumulated_gradients = None
+        self.accumulated_loss = None
+        self.accumulated_finite_steps = None
+        return True
 
-    def update(self):
+    def _masked_step(self, condition):
+        """
+        Method. It steps the optimizer and then restores the previous values of the parameters and of the state of the
+        optimizer (e.g. the moment estimates of Adam) where the condition is False. The state that did not exist before
+        the step is restored to zero.
+        """
+        parameters = [parameter for group in self.optimizer.param_groups for parameter in group["params"]]
+        previous_values = [parameter.detach().clone() for parameter in parameters]
+        previous_states = [{key: value.clone() for key, value in self.optimizer.state[parameter].items()
+                            if torch.is_tensor(value)} for parameter in parameters]
         self.optimizer.step()
+        with torch.no_grad():
+            for parameter, previous_value, previous_state in zip(parameters, previous_values, previous_states):
+                parameter.copy_(torch.where(condition, parameter, previous_value))
+                for key, value in self.optimizer.state[parameter].items():
+                    if torch.is_tensor(value):
+                        previous = previous_state.get(key, None)
+                        value.copy_(torch.where(condition.to(value.device),
+                                                value, previous if previous is not None else torch.zeros_like(value)))
+
+    def _step_scheduler(self, loss, number_steps):
+        if self.scheduler is None:
+            return
+        if isinstance(self.scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+            if loss is None:
+                raise ValueError("The scheduler {} requires the loss: pass it to update or return it from the "
+                                 "closure".format(type(self.scheduler).__name__))
+            self.scheduler.step((loss.detach() if torch.is_tensor(loss) else loss)/number_steps)
+        else:
+            self.scheduler.step()
+
+    def mask_gradients(self, condition):
+        """
+        Method. It sets to zero the gradients of all the parameters when the condition is False. The condition is a
+        boolean tensor, so that the gradients of numerically unstable iterations are dropped without synchronizing the
+        device with the host.
+        """
+        for parameter in self.module.parameters():
+            if parameter.grad is not None:
+                parameter.grad.masked_fill_(~condition, 0.)
 
     def zero_grad(self):
-        self.optimizer.zero_grad()
\ No newline at end of file
+        self.optimizer.zero_grad()
+
+    def state_dict(self):
+        """
+        Method. It returns the state of the optimizer and the values of all the parameters it optimizes.
+        """
+        parameters = list(self.module.parameters())
+        accumulated_gradients = [self.accumulated_gradients.get(parameter, None) for parameter in parameters] \
+            if self.accumulated_gradients is not None else None
+        return {"module": self.module.state_dict(), "optimizer": self.optimizer.state_dict(),
+                "scheduler": self.scheduler.state_dict() if self.scheduler is not None else None,
+                "accumulated_steps": self.accumulated_steps, "accumulated_gradients": accumulated_gradients,
+                "accumulated_loss": self.accumulated_loss, "accumulated_finite_steps": self.accumulated_finite_steps}
+
+    def load_state_dict(self, state_dict):
+        """
+        Method. It restores the state returned by state_dict. The parameters are updated in place.
+        """
+        self.module.load_state_dict(state_dict["module"])
+        self.optimizer.load_state_dict(state_dict["optimizer"])
+        if self.scheduler is not None and state_dict.get("scheduler", None) is not None:
+            self.scheduler.load_state_dict(state_dict["scheduler"])
+        self.accumulated_steps = state_dict.get("accumulated_steps", 0)
+        self.accumulated_loss = state_dict.get("accumulated_loss", None)
+        self.accumulated_finite_steps = state_dict.get("accumulated_finite_steps", None)
+        accumulated_gradients = state_dict.get("accumulated_gradients", None)
+        if accumulated_gradients is not None:
+            self.accumulated_gradients = {parameter: gradient
+                                          for parameter, gradient in zip(self.module.parameters(), accumulated_gradients)
+                                          if gradient is not None}
+        else:
+            self.accumulated_gradients = None
\ No newline at end of file
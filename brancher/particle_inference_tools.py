@@ -1,8 +1,11 @@
 import numpy as np
+import torch
 
 
-from brancher.variables import DeterministicVariable
+from brancher.modules import ParameterModule
+from brancher.variables import DeterministicVariable, ProbabilisticModel
 from brancher.utilities import is_tensor
+from brancher.utilities import coerce_to_dtype
 
 class VoronoiSet(object):
 
@@ -31,3 +34,113 @@ class VoronoiSet(object):
         else:
             return False
 
+
+class ParticleVariable(DeterministicVariable):
+    """
+    Learnable deterministic variable that stores the locations of all the particles of a ParticleSet in a single
+    parameter. The leading dimension of the parameter is the particle dimension, so that the value of the variable is
+    directly a batch of samples with one sample per particle.
+
+    Parameters
+    ----------
+    locations : torch.Tensor. Stacked locations of the particles, with shape (number_particles, 1, ...) (see
+    ParticleSet).
+
+    name : String. The name of the variable.
+    """
+    __slots__ = ()
+
+    def __init__(self, locations, name):
+        self.name = name
+        self._observed = False
+        self.parents = set()
+        self._type = "Deterministic"
+        self.learnable = True
+        self._value = torch.nn.Parameter(locations, requires_grad=True)
+        self.link = ParameterModule(self._value)
+
+    @property
+    def number_particles(self):
+        return self._value.shape[0]
+
+    def _get_sample(self, number_samples, resample=False, observed=False, input_values={}, context=None):
+        if self in input_values:
+            return {self: input_values[self]}
+        if number_samples == self.number_particles:
+            return {self: self.value}
+        indices = torch.randint(0, self.number_particles, (number_samples,), device=self._value.device)
+        return {self: self.value[indices]}
+
+
+class ParticleSet(ProbabilisticModel):
+    """
+    Collection of particles stored as one learnable tensor per variable. A ParticleSet can be used as the posterior
+    model of the particle inference methods (e.g. SteinVariationalGradientDescent): the particles are sampled, evaluated
+    and updated in batch, with a single parameter per variable in the optimizer.
+
+    When the number of requested samples is equal to the number of particles, the samples are the particles in order.
+    Otherwise, the particles are resampled with replacement, with the same particle indices for all the variables.
+
+    Parameters
+    ----------
+    locations : Dictionary(String: torch.Tensor, np.ndarray or List). Initial locations of the particles of each
+    variable. The first dimension (or the list) runs over the particles and all the variables should have the same
+    number of particles.
+    """
+    def __init__(self, locations):
+        particle_variables = [ParticleVariable(self._stack_locations(variable_locations), name)
+                              for name, variable_locations in sorted(locations.items())]
+        number_particles = set([var.number_particles for var in particle_variables])
+        if len(number_particles) != 1:
+            raise ValueError("All the variables of a ParticleSet should have the same number of particles")
+        self.number_particles = number_particles.pop()
+        super().__init__(particle_variables)
+
+    @classmethod
+    def from_particles(cls, particles):
+        """
+        Method. It builds a ParticleSet from a list of particles represented as probabilistic models of learnable
+        DeterministicVariables.
+
+        Args:
+            particles: List(brancher.ProbabilisticModel).
+
+        Returns:
+            brancher.ParticleSet.
+        """
+        names = [var.name for var in particles[0].variables]
+        return cls({name: [particle.get_variable(name).value.detach()[0, 0] for particle in particles]
+                    for name in names})
+
+    @staticmethod
+    def _stack_locations(locations):
+        """
+        Method. It stacks the location of each particle, with the shape of the value of a DeterministicVariable
+        initialized with it, in a (number_particles, 1, ...) tensor.
+        """
+        locations = [float(location) if is_tensor(location) and location.dim() == 0 else location
+                     for location in locations]
+        return torch.cat([coerce_to_dtype(location)[0] for location in locations], dim=0).unsqueeze(1)
+
+    def __len__(self):
+        return self.number_particles
+
+    def get_locations(self):
+        """
+        Method. It returns the location parameters of the particles, sorted by the name of their variables.
+
+        Args: None.
+
+        Returns: List(torch.nn.Parameter).
+        """
+        return [var.value for var in self.variables]
+
+    def _get_sample(self, number_samples, observed=False, input_values={}, context=None):
+        if number_samples == self.number_particles:
+            indices = None
+        else:
+            indices = torch.randint(0, self.number_particles, (number_samples,),
+                                    device=self.variables[0].value.device)
+        sample = {var: var.value if indices is None else var.value[indices] for var in self.variables}
+        sample.update(input_values)
+        return sample
@@ -7,6 +7,7 @@ import brancher.distributions as distributions
 import brancher.functions as BF
 import brancher.geometric_ranges as geometric_ranges
 from brancher.variables import var2link, Variable, DeterministicVariable, RandomVariable, PartialLink
+from brancher.expressions import CompiledExpression
 from brancher.utilities import join_sets_list
 
 
@@ -24,9 +25,10 @@ class LinkConstructor(nn.ModuleList):
                  for partial_link in kwargs.values()
                  for link in var2link(partial_link).links]
         super().__init__(modules) #TODO: asserts that specified links are valid pytorch modules
+        self.compiled_links = CompiledExpression({k: var2link(x).node for k, x in kwargs.items()})
 
     def __call__(self, values):
-        return {k: var2link(x).fn(values) for k, x in self.kwargs.items()}
+        return self.compiled_links(values)
 
 
 class VariableConstructor(RandomVariable):
@@ -36,21 +38,20 @@ class VariableConstructor(RandomVariable):
     Parameters
     ----------
     """
+    __slots__ = ("ranges", "is_normalized", "partial_links")
+
     def __init__(self, name, learnable, ranges, is_observed=False, **kwargs): #TODO: code duplication here
         self.name = name
-        self._evaluated = False
         self._observed = is_observed
         self._observed_value = None
-        self._current_value = None
         self.construct_deterministic_parents(learnable, ranges, kwargs)
         self.parents = join_sets_list([var2link(x).vars for x in kwargs.values()])
-        self.ancestors = join_sets_list([self.parents] + [parent.ancestors for parent in self.parents])
         self.link = LinkConstructor(**kwargs)
-        self.samples = None
         self.ranges = {}
         self.dataset = None
         self.has_random_dataset = False
         self.has_observed_value = False
+        self.is_sharded = False
         self.is_normalized = True
         self.partial_links = {name: var2link(link) for name, link in kwargs.items()}
 
@@ -75,6 +76,8 @@ class EmpiricalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ("batch_size",)
+
     def __init__(self, dataset, name, learnable=False, is_observed=False, batch_size=None, indices=None, weights=None): #TODO: Ugly logic
         self._type = "Empirical"
         input_parameters = {"dataset": dataset, "batch_size": batch_size, "indices": indices, "weights": weights}
@@ -103,6 +106,8 @@ class RandomIndices(EmpiricalVariable):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, dataset_size, batch_size, name, is_observed=False):
         self._type = "Random Index"
         super().__init__(dataset=list(range(dataset_size)),
@@ -119,6 +124,8 @@ class NormalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, loc, scale, name, learnable=False):
         self._type = "Normal"
         ranges = {"loc": geometric_ranges.UnboundedRange(),
@@ -142,6 +149,8 @@ class CauchyVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, loc, scale, name, learnable=False):
         self._type = "Cauchy"
         ranges = {"loc": geometric_ranges.UnboundedRange(),
@@ -157,6 +166,8 @@ class LaplaceVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, loc, scale, name, learnable=False):
         self._type = "Laplace"
         ranges = {"loc": geometric_ranges.UnboundedRange(),
@@ -172,6 +183,8 @@ class LogNormalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, loc, scale, name, learnable=False):
         self._type = "Log Normal"
         ranges = {"loc": geometric_ranges.UnboundedRange(),
@@ -187,6 +200,8 @@ class LogitNormalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, loc, scale, name, learnable=False):
         self._type = "Logit Normal"
         ranges = {"loc": geometric_ranges.UnboundedRange(),
@@ -202,6 +217,8 @@ class BetaVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, alpha, beta, name, learnable=False):
         self._type = "Logit Normal"
         ranges = {"alpha": geometric_ranges.RightHalfLine(0.),
@@ -217,6 +234,8 @@ class BinomialVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, n, p=None, logit_p=None, name="Binomial", learnable=False):
         self._type = "Binomial"
         if p is not None and logit_p is None:
@@ -241,6 +260,8 @@ class CategoricalVariable(VariableConstructor): #TODO: Work in progress
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, p=None, softmax_p=None, name="Categorical", learnable=False):
         self._type = "Categorical"
         if p is not None and softmax_p is None:
@@ -263,6 +284,8 @@ class ConcreteVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, tau, p, name, learnable=False):
         self._type = "Concrete"
         ranges = {"tau": geometric_ranges.RightHalfLine(0.),
@@ -278,6 +301,8 @@ class MultivariateNormalVariable(VariableConstructor):
     Parameters
     ----------
     """
+    __slots__ = ()
+
     def __init__(self, loc, covariance_matrix=None, precision_matrix=None, cholesky_factor=None, name="Multivariate Normal", learnable=False):
         self._type = "Multivariate Normal"
         if cholesky_factor is not None and covariance_matrix is None and precision_matrix is None:
@@ -8,9 +8,9 @@ from brancher.utilities import concatenate_samples, reject_samples
 
 def truncate_model(model, truncation_rule, model_statistics):
 
-    def truncated_calculate_log_probability(rv_values, for_gradient=False, normalized=True):
+    def truncated_calculate_log_probability(rv_values, for_gradient=False, normalized=True, context=None):
         unnormalized_log_probability = model.calculate_log_probability(rv_values, normalized=normalized,
-                                                                       for_gradient=for_gradient)
+                                                                       for_gradient=for_gradient, context=context)
         if not normalized:
             return unnormalized_log_probability
         else:
@@ -22,7 +22,8 @@ def truncate_model(model, truncation_rule, model_statistics):
             else:
                 raise NotImplemented #TODO: Work in progress
 
-    def truncated_get_sample(number_samples, **kwargs):  # TODO: Work in progress
+    def truncated_get_sample(number_samples, context=None, **kwargs):  # TODO: Work in progress
+        # The context is not forwarded: the stored link outputs would not match the samples that survive the rejection
         batch_size = number_samples
         current_number_samples = 0
         sample_list = []
@@ -215,6 +215,21 @@ def uniform_shapes(*args):
 
 
 def get_model_mapping(source_model, target_model):
+    """
+    It returns a dictionary that maps the variables of the source model to the variables of the target model with the
+    same name. When the source is a probabilistic model and the target is not a dictionary, the mapping is computed
+    once and cached on the source model.
+    """
+    if not hasattr(source_model, "_model_mappings") or isinstance(target_model, dict):
+        return _build_model_mapping(source_model, target_model)
+    model_mapping = source_model._model_mappings.get(target_model)
+    if model_mapping is None:
+        model_mapping = _build_model_mapping(source_model, target_model)
+        source_model._model_mappings[target_model] = model_mapping
+    return model_mapping
+
+
+def _build_model_mapping(source_model, target_model):
     model_mapping = {}
     if isinstance(target_model, dict):
         target_variables = list(target_model.keys())
@@ -229,19 +244,15 @@ def get_model_mapping(source_model, target_model):
 
 
 def reassign_samples(samples, model_mapping=(), source_model=(), target_model=()):
-    out_sample = {}
     if model_mapping:
         pass
     elif source_model and target_model:
         model_mapping = get_model_mapping(source_model, target_model)
     else:
         raise ValueError("Either a model mapping or both source and target models have to be provided as input")
-    for key, value in samples.items():
-        try:
-            out_sample.update({model_mapping[key]: value})
-        except KeyError:
-            pass
-    return out_sample
+    return {target_var: samples[source_var]
+            for source_var, target_var in model_mapping.items()
+            if source_var in samples}
 
 
 def get_memory(obj, seen=None):
@@ -260,6 +271,10 @@ def get_memory(obj, seen=None):
         size += sum([get_memory(k, seen) for k in obj.keys()])
     elif hasattr(obj, '__dict__'):
         size += get_memory(obj.__dict__, seen)
+    elif hasattr(type(obj), '__slots__') and not isinstance(obj, (str, bytes, bytearray)):
+        slots = [slot for cls in type(obj).__mro__ for slot in getattr(cls, '__slots__', ())
+                 if slot != '__weakref__']
+        size += sum([get_memory(getattr(obj, slot), seen) for slot in slots if hasattr(obj, slot)])
     elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
         size += sum([get_memory(i, seen) for i in obj])
     return size
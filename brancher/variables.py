@@ -6,10 +6,12 @@ Module description
 from abc import ABC, abstractmethod
 import operator
 import numbers
-import collections
-from collections.abc import Iterable
+from collections.abc import Iterable, Hashable
+import weakref
 
 from brancher.modules import ParameterModule
+from brancher.expressions import VariableNode, ConstantNode, OperationNode, CompiledExpression
+from brancher.expressions import pack_tuple, get_shape
 
 import numpy as np
 import pandas as pd
@@ -36,11 +38,49 @@ from brancher.pandas_interface import pandas_frame2dict
 from brancher.pandas_interface import pandas_frame2value
 
 from brancher.config import device
+from brancher.distributed import get_world_size
+from brancher.kl_divergences import has_analytic_kl, calculate_kl
+
+_INPUT_STEP, _DETERMINISTIC_STEP, _OBSERVED_STEP, _RANDOM_STEP = range(4)
+
+
+class EvaluationContext(object):
+    """
+    EvaluationContext stores the transient state of a single call that samples or evaluates a model: the samples that
+    are shared between the children of a variable, the variables whose log probability has already been evaluated and
+    the output of the link (the parameters of the distribution) of each sampled variable, so that the log probability of
+    the same sample can be computed without evaluating the links again. Variables and models do not store any state
+    during evaluation, so they can be sampled and evaluated concurrently as long as each call uses its own context.
+    """
+    def __init__(self):
+        self.samples = {}
+        self.evaluated = set()
+        self.link_outputs = {}
+
+    def store_link_output(self, variable, parents_values, parameters):
+        self.link_outputs[variable] = (parents_values, parameters)
+
+    def get_link_output(self, variable, parents_values):
+        """
+        Method. It returns the cached parameters of the variable if they were computed from the same values of its
+        non-deterministic parents. Otherwise it returns None.
+        """
+        if variable not in self.link_outputs:
+            return None
+        cached_parents_values, parameters = self.link_outputs[variable]
+        for parent, value in parents_values.items():
+            if type(parent) is not DeterministicVariable and cached_parents_values.get(parent) is not value:
+                return None
+        return parameters
+
 
 class BrancherClass(ABC):
     """
     BrancherClass is the abstract superclass of all Brancher variables and models.
     """
+    __slots__ = ()
+    _graph_version = 0 # Incremented every time the observation state of a variable changes
+
     @abstractmethod
     def _flatten(self):
         """
@@ -74,8 +114,10 @@ class Variable(BrancherClass):
     Variable is the abstract superclass of deterministic and random variables. Variables are the building blocks of
     all probabilistic models in Brancher.
     """
+    __slots__ = ("__weakref__",)
+
     @abstractmethod
-    def calculate_log_probability(self, values, reevaluate):
+    def calculate_log_probability(self, values, reevaluate, context):
         """
         Abstract method. It returns the log probability of the values given the model.
 
@@ -84,8 +126,11 @@ class Variable(BrancherClass):
             model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
             the model except for the deterministic variables.
 
-            reevaluate: Bool. If false it returns the output of the latest call. It avoid unnecessary computations when
-            multiple children variables ask for the log probability of the same paternt variable.
+            reevaluate: Bool. If false it returns 0 for the variables that have already been evaluated in the context.
+            It avoid unnecessary computations when multiple children variables ask for the log probability of the same
+            paternt variable.
+
+            context: brancher.EvaluationContext. The state of the current evaluation. A new context is created if None.
 
         Returns:
             torch.Tensor. the log probability of the input values given the model.
@@ -94,7 +139,7 @@ class Variable(BrancherClass):
         pass
 
     @abstractmethod
-    def _get_sample(self, number_samples, resample, observed, input_values):
+    def _get_sample(self, number_samples, resample, observed, input_values, context):
         """
         Abstract method. It returns samples from the joint distribution specified by the model. If an input is provided
         it only samples the variables that are not contained in the input.
@@ -102,9 +147,9 @@ class Variable(BrancherClass):
         Args:
             number_samples: Int.
 
-            resample: Bool. If true it returns its previously stored sampled. It is used when multiple children variables
-            ask for a sample to the same parent. In this case the resample variable is False since the children should be
-            fed with the same value of the parent.
+            resample: Bool. If false it returns the sample previously stored in the context. It is used when multiple
+            children variables ask for a sample to the same parent. In this case the resample variable is False since the
+            children should be fed with the same value of the parent.
 
             observed: Bool. It specifies whether the samples should be interpreted frequentistically as samples from the
             observations of as Bayesian samples from the prior model. The first batch dimension is reserved to Bayesian
@@ -116,6 +161,8 @@ class Variable(BrancherClass):
             the model that do not need to be sampled. Using an input allows to use a probabilistic model as a random
             function.
 
+            context: brancher.EvaluationContext. The state of the current sampling call. A new context is created if None.
+
         Returns:
             Dictionary(brancher.Variable: torch.Tensor). A dictionary of samples from all the variables of the model
 
@@ -128,14 +175,12 @@ class Variable(BrancherClass):
         raw_sample = {self: self._get_sample(number_samples, resample=False,
                                              observed=self.is_observed, input_values=reformatted_input_values)[self]}
         sample = reformat_sample_to_pandas(raw_sample, number_samples)
-        self.reset()
         return sample
 
-    @abstractmethod
     def reset(self):
         """
-        Abstract method. It recursively resets the self._evalueted and self._current_value attributes of the variable and
-        all downstream variables. It is used after sampling and evaluating the log probability of a model.
+        Method. It does nothing. Variables do not store any state during sampling and evaluation since the transient
+        state is kept in a brancher.EvaluationContext. Kept for backward compatibility.
 
         Args: None.
 
@@ -143,6 +188,25 @@ class Variable(BrancherClass):
         """
         pass
 
+    @property
+    def ancestors(self):
+        """
+        Property. It returns the set of all the variables that precede the variable in the graph. The set is computed
+        on demand with a single traversal of the parents, variables do not store their ancestors.
+
+        Args: None.
+
+        Returns: Set(brancher.Variable).
+        """
+        ancestors = set()
+        stack = list(self.parents)
+        while stack:
+            var = stack.pop()
+            if var not in ancestors:
+                ancestors.add(var)
+                stack.extend(var.parents)
+        return ancestors
+
     @property
     @abstractmethod
     def is_observed(self):
@@ -169,8 +233,8 @@ class Variable(BrancherClass):
         """
         Method. It is used for performing symbolic operations between variables. It always returns a partialLink object
         that define a mathematical operation between variables. The vars attribute of the link is the set of variables
-        that are used in the operation. The fn attribute is a lambda that specify the operation as a functions between the
-        values of the variables in vars and a numeric output. This is required for defining the forward pass of the model.
+        that are used in the operation. The node attribute is the expression graph of the operation as a function of the
+        values of the variables in vars. This is required for defining the forward pass of the model.
 
         Args:
             other: PartialLink, RandomVariable, numeric or np.array.
@@ -180,22 +244,21 @@ class Variable(BrancherClass):
         Returns: PartialLink
         """
         if isinstance(other, PartialLink):
-            vars = other.vars
-            vars.add(self)
-            fn = lambda values: op(values[self], other.fn(values))
+            vars = other.vars.union({self})
+            node = OperationNode(op, (VariableNode(self), other.node))
             links = other.links
         elif isinstance(other, Variable):
             vars = {self, other}
-            fn = lambda values: op(values[self], values[other])
+            node = OperationNode(op, (VariableNode(self), VariableNode(other)))
             links = set()
         elif isinstance(other, (numbers.Number, np.ndarray)):
             vars = {self}
-            fn = lambda values: op(values[self], other)
+            node = OperationNode(op, (VariableNode(self), ConstantNode(other)))
             links = set()
         else:
             return other*self
 
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return PartialLink(vars=vars, node=node, links=links)
 
     def __neg__(self):
         return -1*self
@@ -231,20 +294,20 @@ class Variable(BrancherClass):
         raise NotImplementedError
 
     def __getitem__(self, key):
-        if isinstance(key, collections.Iterable):
+        if isinstance(key, Iterable):
             variable_slice = (slice(None, None, None), *key)
         else:
             variable_slice = (slice(None, None, None), key)
         vars = {self}
-        fn = lambda values: values[self][variable_slice]
+        node = OperationNode(operator.getitem, (VariableNode(self), ConstantNode(variable_slice)))
         links = set()
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return PartialLink(vars=vars, node=node, links=links)
 
     def shape(self):
         vars = {self}
-        fn = lambda values: values[self].shape
+        node = OperationNode(get_shape, (VariableNode(self),))
         links = set()
-        return PartialLink(vars=vars, fn=fn, links=links)
+        return PartialLink(vars=vars, node=node, links=links)
 
 
 class DeterministicVariable(Variable):
@@ -263,12 +326,12 @@ class DeterministicVariable(Variable):
     learnable : Bool. This boolean value specify if the value of the DeterministicVariable can be updated during traning.
 
     """
+    __slots__ = ("name", "_observed", "parents", "_type", "learnable", "link", "_value")
+
     def __init__(self, data, name, learnable=False, is_observed=False):
         self.name = name
-        self._evaluated = False
         self._observed = is_observed
         self.parents = set()
-        self.ancestors = set()
         self._type = "Deterministic"
         self.learnable = learnable
         self.link = None
@@ -282,7 +345,7 @@ class DeterministicVariable(Variable):
                 warnings.warn('Currently discrete parameters are not learnable. Learnable set to False')
 
 
-    def calculate_log_probability(self, values, reevaluate=True, for_gradient=False, normalized=True):
+    def calculate_log_probability(self, values, reevaluate=True, for_gradient=False, normalized=True, context=None):
         """
         Method. It returns the log probability of the values given the model. This value is always 0 since the probability
         of a deterministic variable having its value is always 1.
@@ -311,7 +374,7 @@ class DeterministicVariable(Variable):
     def is_observed(self):
         return self._observed
 
-    def _get_sample(self, number_samples, resample=False, observed=False, input_values={}):
+    def _get_sample(self, number_samples, resample=False, observed=False, input_values={}, context=None):
         if self in input_values:
             value = input_values[self]
         else:
@@ -321,9 +384,6 @@ class DeterministicVariable(Variable):
         else:
             return {self: value} #TODO: This is for allowing discrete data, temporary? (for Julia)
 
-    def reset(self):
-        pass
-
     def _flatten(self):
         return []
 
@@ -344,21 +404,21 @@ class RandomVariable(Variable):
         A function Dictionary(brancher.variable: torch.tensor) -> Dictionary(str: torch.tensor) that maps the values of all the parents
         to a dictionary of parameters of the probability distribution. It can also contains learnable layers and parameters.
     """
+    __slots__ = ("name", "distribution", "link", "parents", "_type", "_observed", "_observed_value",
+                 "dataset", "has_random_dataset", "has_observed_value", "is_sharded")
+
     def __init__(self, distribution, name, parents, link):
         self.name = name
         self.distribution = distribution
         self.link = link
         self.parents = parents
-        self.ancestors = None
         self._type = "Random"
-        self.samples = None
-
-        self._evaluated = False
         self._observed = False # RandomVariable: observed value + link
         self._observed_value = None # need this?
         self.dataset = None
         self.has_random_dataset = False
         self.has_observed_value = False
+        self.is_sharded = False
 
     @property
     def value(self):
@@ -395,7 +455,7 @@ class RandomVariable(Variable):
         return output
 
     def calculate_log_probability(self, input_values, reevaluate=True, for_gradient=False,
-                                  include_parents=True, normalized=True):
+                                  include_parents=True, normalized=True, context=None):
         """
         Method. It returns the log probability of the values given the model. This value is always 0 since the probability
         of a deterministic variable having its value is always 1.
@@ -405,32 +465,25 @@ class RandomVariable(Variable):
             model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
             the model except for the deterministic variables.
 
-            reevaluate: Bool. If false it returns the output of the latest call. It avoid unnecessary computations when
-            multiple children variables ask for the log probability of the same paternt variable.
+            reevaluate: Bool. If false it returns 0 when the variable has already been evaluated in the context. It avoid
+            unnecessary computations when multiple children variables ask for the log probability of the same paternt
+            variable.
+
+            context: brancher.EvaluationContext. The state of the current evaluation. A new context is created if None.
 
         Returns:
             torch.Tensor. The log probability of the input values given the model.
 
         """
-        if self._evaluated and not reevaluate:
+        if context is None:
+            context = EvaluationContext()
+        if self in context.evaluated and not reevaluate:
             return 0.
-        if self in input_values:
-            value = input_values[self]
-        else:
-            value = self.value
-
-        self._evaluated = True
-        deterministic_parents_values = {parent: parent.value for parent in self.parents
-                                        if (type(parent) is DeterministicVariable)}
-        parents_input_values = {parent: parent_input for parent, parent_input in input_values.items() if parent in self.parents}
-        parents_values = {**parents_input_values, **deterministic_parents_values}
-        parameters_dict = self._apply_link(parents_values)
-        log_probability = self.distribution.calculate_log_probability(value, **parameters_dict)
+        context.evaluated.add(self)
+        log_probability = self._calculate_log_probability_factor(input_values, context)
         parents_log_probability = sum([parent.calculate_log_probability(input_values, reevaluate, for_gradient,
-                                                                        normalized=normalized)
+                                                                        normalized=normalized, context=context)
                                        for parent in self.parents])
-        if self.is_observed:
-            log_probability = log_probability.sum(dim=1, keepdim=True)
         if is_tensor(log_probability) and is_tensor(parents_log_probability):
             log_probability, parents_log_probability = partial_broadcast(log_probability, parents_log_probability)
         if include_parents:
@@ -438,7 +491,54 @@ class RandomVariable(Variable):
         else:
             return log_probability
 
-    def _get_sample(self, number_samples=1, resample=True, observed=False, input_values={}):
+    def _calculate_log_probability_factor(self, input_values, context=None):
+        """
+        Method. It returns the log probability of the value of the variable given the values of its parents, without
+        including the log probability of the parents.
+
+        Args:
+            input_values: Dictionary(brancher.Variable: torch.Tensor). It has to provide values for the variable (unless
+            it is observed) and for all its non-deterministic parents.
+
+            context: brancher.EvaluationContext. If given, the parameters computed by the link when the variable was
+            sampled are reused.
+
+        Returns:
+            torch.Tensor. The log probability factor of the variable.
+        """
+        if self in input_values:
+            value = input_values[self]
+        else:
+            value = self.value
+        parameters_dict = self._get_parameters(input_values, context)
+        log_probability = self.distribution.calculate_log_probability(value, **parameters_dict)
+        if self.is_observed:
+            log_probability = log_probability.sum(dim=1, keepdim=True)
+        return log_probability
+
+    def _get_parameters(self, input_values, context=None):
+        """
+        Method. It returns the parameters of the distribution of the variable given the values of its parents.
+
+        Args:
+            input_values: Dictionary(brancher.Variable: torch.Tensor). It has to provide values for all the
+            non-deterministic parents of the variable.
+
+            context: brancher.EvaluationContext. If given, the parameters computed by the link when the variable was
+            sampled are reused.
+
+        Returns:
+            Dictionary(str: torch.Tensor).
+        """
+        parents_values = {parent: input_values[parent] for parent in self.parents if parent in input_values}
+        parents_values.update({parent: parent.value for parent in self.parents
+                               if type(parent) is DeterministicVariable})
+        parameters_dict = context.get_link_output(self, parents_values) if context is not None else None
+        if parameters_dict is None:
+            parameters_dict = self._apply_link(parents_values)
+        return parameters_dict
+
+    def _get_sample(self, number_samples=1, resample=True, observed=False, input_values={}, context=None):
         """
         Method. Used internally. It returns samples from the random variable and all its parents.
 
@@ -447,20 +547,24 @@ class RandomVariable(Variable):
             model as keys and chainer.Variables as values. This dictionary has to provide values for all variables of
             the model except for the deterministic variables.
 
-            resample: Bool. If false it returns the previously sampled values. It avoids that the parents of a variable
-            are sampled multiple times.
+            resample: Bool. If false it returns the values previously sampled in the context. It avoids that the parents
+            of a variable are sampled multiple times.
 
             observed: Bool. It specifies if the sample should be formatted as observed data or Bayesian parameter.
 
             input_values: Dictionary(Variable: torch.Tensor).  dictionary of values of the parents. It is used for
             conditioning the sample on the (inputed) values of some of the parents.
 
+            context: brancher.EvaluationContext. The state of the current sampling call. A new context is created if None.
+
         Returns:
             Dictionary(Variable: torch.Tensor). A dictionary of samples from the variable and all its parents.
 
         """
-        if self.samples is not None and not resample:
-            return {self: self.samples[-1]}
+        if context is None:
+            context = EvaluationContext()
+        if self in context.samples and not resample:
+            return {self: context.samples[self]}
         if not observed:
             if self in input_values:
                 return {self: input_values[self]}
@@ -473,34 +577,44 @@ class RandomVariable(Variable):
                 var_to_sample = self.dataset
             else:
                 var_to_sample = self
-        parents_samples_dict = join_dicts_list([parent._get_sample(number_samples, resample, observed, input_values)
+        parents_samples_dict = join_dicts_list([parent._get_sample(number_samples, resample, observed, input_values,
+                                                                   context=context)
                                                 for parent in var_to_sample.parents])
         input_dict = {parent: parents_samples_dict[parent] for parent in var_to_sample.parents}
         parameters_dict = var_to_sample._apply_link(input_dict)
+        if var_to_sample is self:
+            context.store_link_output(self, input_dict, parameters_dict)
         sample = var_to_sample.distribution.get_sample(**parameters_dict)
-        self.samples = [sample] #TODO: to fix
+        context.samples[self] = sample
         output_sample = {**parents_samples_dict, self: sample}
         return output_sample
 
-    def observe(self, data):
+    def observe(self, data, sharded=False):
         """
         Method. It assigns an observed value to a RandomVariable.
 
         Args:
             data: torch.Tensor, numeric, or np.ndarray. Input observed data.
 
+            sharded: Bool. If True, data is the slice of the observed data owned by the current torch.distributed rank
+            (see brancher.distributed.get_shard). The log probability of the full data is the sum across ranks.
+
         Returns:
             None
 
         """
         data = pandas_frame2value(data, self.name)
         if isinstance(data, RandomVariable):
+            if sharded:
+                raise ValueError("Only observed values can be sharded, not random datasets")
             self.dataset = data
             self.has_random_dataset = True
         else:
             self._observed_value = coerce_to_dtype(data, is_observed=True)
             self.has_observed_value = True
+        self.is_sharded = sharded
         self._observed = True
+        BrancherClass._graph_version += 1
 
     def unobserve(self):
         """
@@ -517,17 +631,8 @@ class RandomVariable(Variable):
         self.has_random_dataset = False
         self._observed_value = None
         self.dataset = None
-
-    def reset(self):
-        """
-        Method. It resets the evaluated flag of the variable and all its parents. Used after computing the
-        log probability of a variable.
-        """
-        if self.samples is not None and not self._evaluated:
-            self.samples = None
-            self._evaluated = False
-            for parent in self.parents:
-                parent.reset()
+        self.is_sharded = False
+        BrancherClass._graph_version += 1
 
     def _flatten(self):
         variables = list(self.ancestors) + [self]
@@ -544,15 +649,25 @@ class ProbabilisticModel(BrancherClass):
     """
     def __init__(self, variables):
         self.variables = self._validate_variables(variables)
-        self._set_summary()
         self.posterior_model = None
         self.posterior_sampler = None
-        self.observed_submodel = None
         self.diagnostics = {}
-        if not all([var.is_observed for var in self.variables]):
-            self.update_observed_submodel()
-        else:
-            self.observed_submodel = self
+        self._clear_compiled_structure()
+
+    def __getstate__(self):
+        """
+        Method. It returns the state used by pickle. The caches keyed by weak references cannot be pickled, they are left
+        out and rebuilt lazily after unpickling.
+        """
+        state = self.__dict__.copy()
+        state.pop("_model_mappings", None)
+        state.pop("_analytic_kl_pairs", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._model_mappings = weakref.WeakKeyDictionary()
+        self._analytic_kl_pairs = weakref.WeakKeyDictionary()
 
     def __str__(self):
         """
@@ -571,23 +686,118 @@ class ProbabilisticModel(BrancherClass):
                 raise ValueError("Invalid input type: {}".format(type(var)))
         return variables
 
+    def _clear_compiled_structure(self):
+        """
+        Method. It drops the cached structural index and all the compiled execution plans of the model. They are
+        lazily rebuilt the next time they are needed.
+        """
+        self._index = None
+        self._observed_submodel = None
+        self._model_summary = None
+        self._sampling_plans = {}
+        self._log_probability_factors = None
+        self._factor_shard_weights = None
+        self._model_mappings = weakref.WeakKeyDictionary()
+        self._analytic_kl_pairs = weakref.WeakKeyDictionary()
+        self._compiled_version = BrancherClass._graph_version
+
+    def _check_compiled_version(self):
+        """
+        Method. It drops the cached structure of the model if the observation state of any variable has changed since
+        it was compiled.
+        """
+        if self._compiled_version != BrancherClass._graph_version:
+            self._clear_compiled_structure()
+
+    def _get_index(self):
+        """
+        Method. It returns the (cached) structural index of the model. The index is built and published as a single
+        object, so that concurrent callers never observe a partially built index.
+
+        Args: None.
+
+        Returns: Tuple(List(brancher.Variable), Dictionary(str: brancher.Variable),
+        Dictionary(brancher.Variable: List(brancher.Variable))). The flat list of variables, the name index and the
+        parent-children adjacency.
+        """
+        self._check_compiled_version()
+        index = self._index
+        if index is None:
+            index = self._build_index()
+            self._index = index
+        return index
+
+    def _build_index(self):
+        """
+        Method. It collects all the variables of the model and their ancestors in a single traversal of the graph and
+        builds the name index and the parent-children adjacency of the model.
+        """
+        visited = set()
+        stack = list(self.variables)
+        while stack:
+            var = stack.pop()
+            if var not in visited:
+                visited.add(var)
+                stack.extend(var.parents)
+        flat_variables = sorted(visited, key=lambda v: v.name)
+        variables_by_name = {var.name: var for var in flat_variables}
+        children = {var: [] for var in flat_variables}
+        for var in flat_variables:
+            for parent in var.parents:
+                children[parent].append(var)
+        return flat_variables, variables_by_name, children
+
     def _set_summary(self):
         feature_list = ["Distribution", "Parents", "Observed"]
-        var_list = self.flatten()
+        var_list = self._flatten()
         var_names = [var.name for var in var_list]
         summary_data = [[var._type, var.parents, var.is_observed]
                          for var in var_list]
         self._model_summary = reformat_model_summary(summary_data, var_names, feature_list)
+        return self._model_summary
 
     @property
     def model_summary(self):
-        self._set_summary()
-        return self._model_summary
+        self._check_compiled_version()
+        model_summary = self._model_summary
+        if model_summary is None:
+            model_summary = self._set_summary()
+        return model_summary
 
     @property
     def is_observed(self):
         return all([var.is_observed for var in self._flatten()])
 
+    def get_variable(self, var_name):
+        """
+        It returns the variable in the model with the requested name.
+
+        Args:
+            var_name: String. Name  of the requested variable.
+
+        Returns:
+            brancher.Variable.
+
+        """
+        variables_by_name = self._get_index()[1]
+        try:
+            return variables_by_name[var_name]
+        except KeyError:
+            raise KeyError("The variable {} is not present in the model".format(var_name))
+
+    def get_children(self, var):
+        """
+        It returns the variables of the model that have the input variable as parent.
+
+        Args:
+            var: brancher.Variable.
+
+        Returns:
+            List(brancher.Variable).
+
+        """
+        return self._get_index()[2][var]
+
     def observe(self, data):
         if isinstance(data, pd.DataFrame):
             data = {var_name: data[var_name].values for var_name in data}
@@ -602,15 +812,31 @@ class ProbabilisticModel(BrancherClass):
             if isinstance(var, RandomVariable):
                 var.observe(data_dict[var])
 
+    @property
+    def observed_submodel(self):
+        """
+        Property. The (cached) sub-model of observed variables. It is rebuilt when the observation state of the
+        variables changes. It always contains every observed variable of the model, so that it is never the model
+        itself: a model whose root variables are all observed can still have observed ancestors that only feed the
+        links (e.g. EmpiricalVariable inputs) and latent ancestors that should not be sampled with the observations.
+        """
+        self._check_compiled_version()
+        observed_submodel = self._observed_submodel
+        if observed_submodel is None:
+            observed_submodel = self.update_observed_submodel()
+        return observed_submodel
+
     def update_observed_submodel(self):
         """
         Method. Extract the sub-model of observed variables.
         """
         flattened_model = self._flatten()
         observed_variables = [var for var in flattened_model if var.is_observed]
-        self.observed_submodel = ProbabilisticModel(observed_variables)
+        self._observed_submodel = ProbabilisticModel(observed_variables)
+        return self._observed_submodel
 
     def set_posterior_model(self, model, sampler=None): #TODO: Clean up code duplication
+        self._clear_compiled_structure()
         self.posterior_model = PosteriorModel(posterior_model=model, joint_model=self)
         if sampler:
             if isinstance(sampler, ProbabilisticModel):
@@ -625,26 +851,186 @@ class ProbabilisticModel(BrancherClass):
             else:
                 raise ValueError("The sampler should be ither a probabilistic model, a brancher variable or an iterable of variables and/or models")
 
-    def calculate_log_probability(self, rv_values, for_gradient=False, normalized=True):
+    def _get_log_probability_factors(self):
         """
-        Summary
+        Method. It returns the (cached) list of random variables of the model. Each of them contributes a single factor
+        to the joint log probability.
+
+        Args: None.
+
+        Returns: List(brancher.RandomVariable).
         """
-        log_probability = sum([var.calculate_log_probability(rv_values, reevaluate=False,
-                                                             for_gradient=for_gradient,
-                                                             normalized=normalized)
-                               for var in self.variables])
-        self.reset()
-        return log_probability
+        self._check_compiled_version()
+        factors = self._log_probability_factors
+        if factors is None:
+            factors = [var for var in self._flatten() if isinstance(var, RandomVariable)]
+            self._log_probability_factors = factors
+        return factors
 
-    def _get_sample(self, number_samples, observed=False, input_values={}):
+    @property
+    def has_sharded_observations(self):
         """
-        Summary
+        Property. True if some variable of the model observes a shard of the data.
+        """
+        return any([var.is_sharded for var in self._get_log_probability_factors()])
+
+    def _get_shard_weights(self):
+        """
+        Method. It returns the (cached) weight of each log probability factor in the sharded evaluation. The factors
+        of the sharded variables are partial sums over the local data and have weight 1, the other factors are
+        evaluated in every rank and are divided by the number of ranks. The cache is keyed by the number of ranks, so
+        that the weights follow a process group that is re-initialized with a different size.
+        """
+        self._check_compiled_version()
+        world_size = get_world_size()
+        cached_weights = self._factor_shard_weights
+        if cached_weights is None or cached_weights[0] != world_size:
+            weights = [1. if var.is_sharded else 1./world_size for var in self._get_log_probability_factors()]
+            cached_weights = (world_size, weights)
+            self._factor_shard_weights = cached_weights
+        return cached_weights[1]
+
+    def calculate_log_probability(self, rv_values, for_gradient=False, normalized=True, context=None, sharded=False,
+                                  excluded_variables=()):
+        """
+        Method. It returns the joint log probability of the values given the model. The log probability factor of each
+        random variable is evaluated once in a single pass and the factors are reduced with a single stacked sum.
+
+        Args:
+            rv_values: Dictionary(brancher.Variable: torch.Tensor). It has to provide values for all the random variables
+            of the model that are not observed.
+
+            context: brancher.EvaluationContext. Context of the sampling pass that generated the values, if any.
+
+            sharded: Bool. If True, it returns the contribution of the current rank to the log probability of the full
+            data: the sum across ranks of the returned values is the joint log probability.
+
+            excluded_variables: Iterable(brancher.RandomVariable). Variables whose factors are left out of the sum.
+
+        Returns:
+            torch.Tensor. The joint log probability of the values.
+        """
+        variables = self._get_log_probability_factors()
+        weights = self._get_shard_weights() if sharded else [1.]*len(variables)
+        if excluded_variables:
+            included = [index for index, var in enumerate(variables) if var not in excluded_variables]
+            variables, weights = [variables[index] for index in included], [weights[index] for index in included]
+        factors = [var._calculate_log_probability_factor(rv_values, context) for var in variables]
+        if sharded:
+            factors = [weight*factor if weight != 1. else factor for weight, factor in zip(weights, factors)]
+        if not factors:
+            return torch.tensor(np.zeros((1, 1))).float().to(device)
+        return torch.stack(partial_broadcast(*factors)).sum(dim=0)
+
+    def _get_sampling_plan(self, observed, input_variables):
+        """
+        Method. It returns the (cached) sampling plan of the model for the given observation mode and set of input
+        variables.
+
+        Args:
+            observed: Bool. It specifies if the plan samples the observations or the prior model.
+
+            input_variables: Frozenset(brancher.Variable). The variables whose values are given as input.
+
+        Returns:
+            List(Tuple). The sampling steps in topological order.
         """
-        joint_sample = join_dicts_list([var._get_sample(number_samples=number_samples, resample=False,
-                                                        observed=observed, input_values=input_values)
-                                        for var in self.variables])
+        self._check_compiled_version()
+        sampling_plans = self._sampling_plans
+        key = (observed, input_variables)
+        plan = sampling_plans.get(key)
+        if plan is None:
+            plan = self._compile_sampling_plan(observed, input_variables)
+            sampling_plans[key] = plan
+        return plan
+
+    def _compile_sampling_plan(self, observed, input_variables):
+        """
+        Method. It sorts topologically the variables that are needed for sampling the model. Each step of the plan is
+        a tuple (step_type, variable, source_variable, parents, parent_ids). The source variable is the variable whose
+        distribution and link are used for sampling (the dataset of the variable if it has a random dataset and the plan
+        is observed). Variables whose value is given as input or observed are leaves of the plan, their parents are only
+        sampled if some other variable requires them. The parents are visited in order of name, so that the order in
+        which the variables are sampled does not depend on the memory layout of the process. Each variable of the plan is
+        identified by a dense integer ID, the position of its step in the plan, and the parent_ids are the IDs of the
+        parents.
+
+        Args:
+            observed: Bool.
+
+            input_variables: Frozenset(brancher.Variable).
+
+        Returns:
+            List(Tuple).
+        """
+        def get_sorted_parents(var):
+            return tuple(sorted(var.parents, key=lambda v: v.name))
+
+        def get_step(var):
+            if isinstance(var, DeterministicVariable):
+                return (_DETERMINISTIC_STEP, var, var, ())
+            if not observed:
+                if var in input_variables:
+                    return (_INPUT_STEP, var, var, ())
+                return (_RANDOM_STEP, var, var, get_sorted_parents(var))
+            if var.has_observed_value:
+                return (_OBSERVED_STEP, var, var, ())
+            source = var.dataset if var.has_random_dataset else var
+            return (_RANDOM_STEP, var, source, get_sorted_parents(source))
+
+        plan = []
+        visited = set()
+        for root in self.variables:
+            stack = [(root, None)]
+            while stack:
+                var, step = stack.pop()
+                if step is not None:
+                    plan.append(step)
+                    continue
+                if var in visited:
+                    continue
+                visited.add(var)
+                step = get_step(var)
+                stack.append((var, step))
+                stack.extend([(parent, None) for parent in step[3] if parent not in visited])
+        variable_ids = {step[1]: variable_id for variable_id, step in enumerate(plan)}
+        return [step + (tuple([variable_ids[parent] for parent in step[3]]),) for step in plan]
+
+    def _get_sample(self, number_samples, observed=False, input_values={}, context=None):
+        """
+        Method. It samples the model in a single pass over its (cached) topologically sorted sampling plan.
+
+        Args:
+            number_samples: Int.
+
+            observed: Bool. It specifies whether the samples should be interpreted frequentistically as samples from the
+            observations of as Bayesian samples from the prior model.
+
+            input_values: Dictionary(brancher.Variable: torch.Tensor). Values of the variables that are not sampled.
+
+            context: brancher.EvaluationContext. If given, the outputs of the links of the sampled variables are stored
+            in the context.
+
+        Returns:
+            Dictionary(brancher.Variable: torch.Tensor). A dictionary of samples from all the variables of the model.
+        """
+        plan = self._get_sampling_plan(observed, frozenset(input_values))
+        values = [None]*len(plan)
+        for variable_id, (step_type, var, source, parents, parent_ids) in enumerate(plan):
+            if step_type == _RANDOM_STEP:
+                parents_values = {parent: values[parent_id] for parent, parent_id in zip(parents, parent_ids)}
+                parameters_dict = source._apply_link(parents_values)
+                if context is not None and source is var:
+                    context.store_link_output(var, parents_values, parameters_dict)
+                values[variable_id] = source.distribution.get_sample(**parameters_dict)
+            elif step_type == _DETERMINISTIC_STEP:
+                values[variable_id] = var._get_sample(number_samples, input_values=input_values)[var]
+            elif step_type == _OBSERVED_STEP:
+                values[variable_id] = var._observed_value
+            else:
+                values[variable_id] = input_values[var]
+        joint_sample = {step[1]: value for step, value in zip(plan, values)}
         joint_sample.update(input_values)
-        self.reset()
         return joint_sample
 
     def get_sample(self, number_samples, input_values={}):
@@ -681,16 +1067,85 @@ class ProbabilisticModel(BrancherClass):
         return sample
 
     def get_p_and_q_log_probabilities(self, q_samples, q_model, empirical_samples={},
-                                      for_gradient=False, normalized=True):  #TODO: Work in progress
-        q_log_prob = q_model.calculate_log_probability(q_samples,
-                                                       for_gradient=for_gradient, normalized=normalized)
+                                      for_gradient=False, normalized=True, context=None, sharded=False,
+                                      analytic_kl_pairs=()):  #TODO: Work in progress
+        if analytic_kl_pairs:
+            q_log_prob = q_model.calculate_log_probability(q_samples, for_gradient=for_gradient, normalized=normalized,
+                                                           context=context,
+                                                           excluded_variables={q_var for _, q_var in analytic_kl_pairs})
+        else:
+            q_log_prob = q_model.calculate_log_probability(q_samples, for_gradient=for_gradient,
+                                                           normalized=normalized, context=context)
         p_samples = reassign_samples(q_samples, source_model=q_model, target_model=self)
         p_samples.update(empirical_samples)
-        p_log_prob = self.calculate_log_probability(p_samples, for_gradient=for_gradient, normalized=normalized)
+        excluded_variables = {p_var for p_var, _ in analytic_kl_pairs}
+        if sharded:
+            p_log_prob = self.calculate_log_probability(p_samples, for_gradient=for_gradient, normalized=normalized,
+                                                        sharded=True, excluded_variables=excluded_variables)
+            q_log_prob = q_log_prob/get_world_size()
+        else:
+            p_log_prob = self.calculate_log_probability(p_samples, for_gradient=for_gradient, normalized=normalized,
+                                                        excluded_variables=excluded_variables)
+        if analytic_kl_pairs:
+            kl_divergence = sum([calculate_kl(q_var.distribution, q_var._get_parameters(q_samples, context),
+                                              p_var.distribution, p_var._get_parameters(p_samples))
+                                 for p_var, q_var in analytic_kl_pairs])
+            p_log_prob = p_log_prob - (kl_divergence/get_world_size() if sharded else kl_divergence)
         return q_log_prob, p_log_prob
 
+    def _get_analytic_kl_pairs(self, posterior_model):
+        """
+        Method. It returns the (cached) pairs of latent random variables of the model and of the posterior model whose
+        KL divergence has a closed form (see brancher.kl_divergences).
+
+        Args:
+            posterior_model: brancher.ProbabilisticModel.
+
+        Returns:
+            List(Tuple(brancher.RandomVariable, brancher.RandomVariable)). The pairs (joint variable, posterior
+            variable).
+        """
+        self._check_compiled_version()
+        pairs = self._analytic_kl_pairs.get(posterior_model, None)
+        if pairs is None:
+            variables_by_name = self._get_index()[1]
+            pairs = []
+            for q_var in posterior_model._get_log_probability_factors():
+                p_var = variables_by_name.get(q_var.name, None)
+                if (isinstance(p_var, RandomVariable) and not p_var.is_observed and not q_var.is_observed
+                        and has_analytic_kl(q_var.distribution, p_var.distribution)):
+                    pairs.append((p_var, q_var))
+            self._analytic_kl_pairs[posterior_model] = pairs
+        return pairs
+
     def get_importance_weights(self, q_samples, q_model, empirical_samples={},
-                               for_gradient=False, give_normalization=False):
+                               for_gradient=False, give_normalization=False, give_effective_sample_size=False,
+                               differentiable=False):
+        """
+        Method. It returns the self-normalized importance weights of samples from the proposal model q_model. The
+        weights are normalized in log space with torch.logsumexp and they stay on the device.
+
+        Args:
+            q_samples: Dictionary(brancher.Variable: torch.Tensor). Samples from the proposal model.
+
+            q_model: brancher.ProbabilisticModel. Proposal model.
+
+            empirical_samples: Dictionary(brancher.Variable: torch.Tensor). Values of the observed variables.
+
+            for_gradient: Bool.
+
+            give_normalization: Bool. If True, it also returns the log normalizer, the logarithm of the mean
+            unnormalized importance weight (an estimate of the log evidence).
+
+            give_effective_sample_size: Bool. If True, it also returns the effective sample size of the weights.
+
+            differentiable: Bool. If True, the outputs are differentiable with respect to the parameters of the
+            models, otherwise they are detached.
+
+        Returns:
+            torch.Tensor. The importance weights, normalized to have mean 1. If requested, it returns a tuple with the
+            weights, the log normalizer and the effective sample size, in this order.
+        """
         if not empirical_samples:
             empirical_samples = self.observed_submodel._get_sample(1, observed=True)
         q_log_prob, p_log_prob = self.get_p_and_q_log_probabilities(q_samples=q_samples,
@@ -698,45 +1153,135 @@ class ProbabilisticModel(BrancherClass):
                                                                     empirical_samples=empirical_samples,
                                                                     for_gradient=for_gradient,
                                                                     normalized=False)
-        log_weights = (p_log_prob - q_log_prob).detach().numpy()
-        alpha = np.max(log_weights)
-        norm_log_weights = log_weights - alpha
-        weights = np.exp(norm_log_weights) #TODO: for Julia: this should either be numpy or cupy
-        norm = np.mean(weights)
-        weights /= norm
-        if not give_normalization:
-            return weights
-        else:
-            return weights, np.log(norm) + alpha
+        log_weights = p_log_prob - q_log_prob
+        if not differentiable:
+            log_weights = log_weights.detach()
+        log_sum = torch.logsumexp(log_weights.flatten(), dim=0)
+        log_normalization = log_sum - np.log(log_weights.numel())
+        weights = torch.exp(log_weights - log_normalization)
+        outputs = [weights]
+        if give_normalization:
+            outputs.append(log_normalization)
+        if give_effective_sample_size:
+            outputs.append(torch.exp(2*log_sum - torch.logsumexp(2*log_weights.flatten(), dim=0)))
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def estimate_log_model_evidence(self, number_samples, method="ELBO", input_values={}, for_gradient=False,
+                                    posterior_model=(), number_importance_samples=10,
+                                    score_function_baseline="leave_one_out", analytic_kl=False):
+        """
+        Method. It returns a stochastic lower bound of the log evidence of the observed data, estimated with samples
+        from the posterior model.
 
-    def estimate_log_model_evidence(self, number_samples, method="ELBO", input_values={}, for_gradient=False, posterior_model=()):
+        Args:
+            number_samples: Int.
+
+            method: String. "ELBO" for the evidence lower bound or "IWAE" for the importance weighted bound, which
+            averages number_importance_samples importance weights inside the logarithm for each of the number_samples
+            outer samples. The IWAE bound is tighter than the ELBO and it converges to the log evidence as the number
+            of importance samples grows.
+
+            input_values: Dictionary(brancher.Variable: torch.Tensor).
+
+            for_gradient: Bool.
+
+            posterior_model: brancher.ProbabilisticModel. By default, the posterior model of the model.
+
+            number_importance_samples: Int. Number of importance samples per outer sample of the IWAE bound.
+
+            score_function_baseline: String. Control variate of the score function gradient of the variables of the
+            posterior model that cannot be reparameterized (e.g. discrete variables). "leave_one_out" subtracts from
+            the bound of each sample the mean bound of the other samples of the batch, "mean" subtracts the mean bound of
+            the batch (which shrinks the gradient by a factor (number_samples - 1)/number_samples) and None does not use
+            a control variate.
+
+            analytic_kl: Bool. If True, the ELBO uses the closed-form KL divergence between the posterior and the prior
+            distribution of the latent variables for which it is available (see brancher.kl_divergences) instead of
+            its Monte Carlo estimate. Only the rest of the log probability ratio is estimated with samples.
+
+        Returns:
+            torch.Tensor.
+        """
         if not posterior_model:
             self.check_posterior_model()
             posterior_model = self.posterior_model
-        if method is "ELBO":
-            empirical_samples = self.observed_submodel._get_sample(1, observed=True) #TODO Important!!: You need to correct for subsampling
-            posterior_samples = posterior_model._get_sample(number_samples=number_samples,
-                                                            observed=False, input_values=input_values)
-            posterior_log_prob, joint_log_prob = self.get_p_and_q_log_probabilities(q_samples=posterior_samples,
-                                                                                    empirical_samples=empirical_samples,
-                                                                                    for_gradient=for_gradient,
-                                                                                    q_model=posterior_model)
-            log_model_evidence = torch.mean(joint_log_prob - posterior_log_prob)
-            return log_model_evidence
+        if method == "ELBO":
+            number_inner_samples = 1
+            analytic_kl_pairs = self._get_analytic_kl_pairs(posterior_model) if analytic_kl else ()
+        elif method == "IWAE":
+            if analytic_kl:
+                raise ValueError("The analytic KL divergence can only be used with the ELBO")
+            if self.has_sharded_observations:
+                raise ValueError("The IWAE bound cannot be evaluated with sharded observations")
+            number_inner_samples = number_importance_samples
+            analytic_kl_pairs = ()
         else:
             raise NotImplementedError("The requested estimation method is currently not implemented.")
+        context = EvaluationContext()
+        empirical_samples = self.observed_submodel._get_sample(1, observed=True) #TODO Important!!: You need to correct for subsampling
+        posterior_samples = posterior_model._get_sample(number_samples=number_samples*number_inner_samples,
+                                                        observed=False, input_values=input_values,
+                                                        context=context)
+        posterior_log_prob, joint_log_prob = self.get_p_and_q_log_probabilities(q_samples=posterior_samples,
+                                                                                empirical_samples=empirical_samples,
+                                                                                for_gradient=for_gradient,
+                                                                                q_model=posterior_model,
+                                                                                context=context,
+                                                                                sharded=self.has_sharded_observations,
+                                                                                analytic_kl_pairs=analytic_kl_pairs)
+        if method == "ELBO":
+            sample_bounds = joint_log_prob - posterior_log_prob
+        else:
+            log_weights = (joint_log_prob - posterior_log_prob).reshape(number_samples, number_inner_samples)
+            sample_bounds = torch.logsumexp(log_weights, dim=1) - np.log(number_inner_samples)
+        log_model_evidence = torch.mean(sample_bounds)
+        score_factors = [var for var in posterior_model._get_log_probability_factors()
+                         if not var.is_observed and not var.distribution.has_rsample]
+        if for_gradient and score_factors:
+            score_log_prob = torch.stack(partial_broadcast(*[var._calculate_log_probability_factor(posterior_samples, context)
+                                                             for var in score_factors])).sum(dim=0)
+            score_log_prob = score_log_prob.reshape(number_samples, number_inner_samples).sum(dim=1)
+            surrogate = self._get_score_function_surrogate(sample_bounds.reshape(number_samples), score_log_prob,
+                                                           score_function_baseline)
+            log_model_evidence = log_model_evidence + (surrogate - surrogate.detach())
+        return log_model_evidence
+
+    @staticmethod
+    def _get_score_function_surrogate(sample_bounds, score_log_prob, baseline):
+        """
+        Method. It returns a surrogate whose gradient is the score function (REINFORCE) estimator of the gradient of the
+        mean bound with respect to the parameters of the non-reparameterizable variables.
+
+        Args:
+            sample_bounds: torch.Tensor. Bound of each sample, with shape (number_samples,).
+
+            score_log_prob: torch.Tensor. Log probability of the non-reparameterizable variables in each sample.
+
+            baseline: String. "leave_one_out", "mean" or None.
+
+        Returns:
+            torch.Tensor.
+        """
+        sample_bounds = sample_bounds.detach()
+        number_samples = sample_bounds.shape[0]
+        if baseline == "leave_one_out":
+            if number_samples > 1:
+                sample_bounds = sample_bounds - (sample_bounds.sum() - sample_bounds)/(number_samples - 1)
+        elif baseline == "mean":
+            sample_bounds = sample_bounds - sample_bounds.mean()
+        elif baseline is not None:
+            raise ValueError("The score function baseline should be either 'leave_one_out', 'mean' or None")
+        return torch.mean(sample_bounds*score_log_prob)
 
     def reset(self):
         """
-        Summary
+        Method. It does nothing. Models do not store any state during sampling and evaluation. Kept for backward
+        compatibility.
         """
-        self._sampled_dict = {}
-        for variable in self.variables:
-            variable.reset()
+        pass
 
     def _flatten(self):
-        variables = list(join_sets_list([var.ancestors.union({var}) for var in self.variables]))
-        return sorted(variables, key=lambda v: v.name)
+        return self._get_index()[0]
 
 
 class PosteriorModel(ProbabilisticModel):
@@ -767,16 +1312,20 @@ class PosteriorModel(ProbabilisticModel):
 def var2link(var):
     if isinstance(var, Variable):
         vars = {var}
-        fn = lambda values: values[var]
+        node = VariableNode(var)
+        links = set()
     elif isinstance(var, (numbers.Number, np.ndarray, torch.Tensor)):
         vars = set()
-        fn = lambda values: var
+        node = ConstantNode(var)
+        links = set()
     elif isinstance(var, (tuple, list)) and all([isinstance(v, (Variable, PartialLink)) for v in var]):
-        vars = join_sets_list([{v} if isinstance(v, Variable) else v.vars for v in var])
-        fn = lambda values: tuple([values[v] if isinstance(v, Variable) else v.fn(values) for v in var])
+        links_list = [var2link(v) for v in var]
+        vars = join_sets_list([link.vars for link in links_list])
+        node = OperationNode(pack_tuple, [link.node for link in links_list])
+        links = join_sets_list([link.links for link in links_list])
     else:
         return var
-    return PartialLink(vars=vars, fn=fn, links=set())
+    return PartialLink(vars=vars, node=node, links=links)
 
 
 class Ensemble(BrancherClass):
@@ -811,16 +1360,39 @@ class Ensemble(BrancherClass):
 
 
 class PartialLink(BrancherClass):
+    """
+    PartialLinks are symbolic functions of the values of brancher variables. They record the operations between
+    variables as an expression graph, which is compiled the first time the link is evaluated.
 
-    def __init__(self, vars, fn, links):
+    Parameters
+    ----------
+    vars : set of brancher variables
+        The variables whose values are used in the expression.
+    node : brancher.expressions.ExpressionNode
+        The root node of the expression graph.
+    links : set of torch.nn.Module
+        The learnable modules used in the expression.
+    """
+    def __init__(self, vars, node, links):
         self.vars = vars
-        self.fn = fn
+        self.node = node
         self.links = links
+        self._compiled_fn = None
+
+    @property
+    def fn(self):
+        """
+        Property. The compiled expression. It is a function Dictionary(brancher.Variable: torch.Tensor) -> output that
+        evaluates each node of the expression graph exactly once.
+        """
+        if self._compiled_fn is None:
+            self._compiled_fn = CompiledExpression(self.node)
+        return self._compiled_fn
 
     def _apply_operator(self, other, op):
         other = var2link(other)
         return PartialLink(vars=self.vars.union(other.vars),
-                           fn=lambda values: op(self.fn(values), other.fn(values)),
+                           node=OperationNode(op, (self.node, other.node)),
                            links=self.links.union(other.links))
 
     def __neg__(self):
@@ -857,29 +1429,30 @@ class PartialLink(BrancherClass):
         raise NotImplementedError
 
     def __getitem__(self, key):
-        if isinstance(key, collections.Iterable) and all([isinstance(k, int) for k in key]):
+        if isinstance(key, Iterable) and all([isinstance(k, int) for k in key]):
             variable_slice = (slice(None, None, None), *key)
         elif isinstance(key, int):
             variable_slice = (slice(None, None, None), key)
-        elif isinstance(key, collections.Hashable):
+        elif isinstance(key, Hashable):
             variable_slice = key
         else:
             raise ValueError("The input to __getitem__ is neither numeric nor a hashabble key")
 
-        vars = self.vars
-        fn = lambda values: self.fn(values)[variable_slice] if is_tensor(self.fn(values)) else self.fn(values)[key] #TODO: this should be a def not a lambda
-        links = set()
-        return PartialLink(vars=vars,
-                           fn=fn,
+        node = OperationNode(_get_link_item, (self.node, ConstantNode(key), ConstantNode(variable_slice)))
+        return PartialLink(vars=self.vars,
+                           node=node,
                            links=self.links)
 
     def shape(self):
-        vars = self.vars
-        fn = lambda values: self.fn(values).shape
-        links = set()
-        return PartialLink(vars=vars,
-                           fn=fn,
+        return PartialLink(vars=self.vars,
+                           node=OperationNode(get_shape, (self.node,)),
                            links=self.links)
 
     def _flatten(self):
         return flatten_list([var._flatten() for var in self.vars]) + [self]
+
+
+def _get_link_item(value, key, variable_slice):
+    if is_tensor(value):
+        return value[variable_slice]
+    return value[key]
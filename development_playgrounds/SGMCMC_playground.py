@@ -0,0 +1,46 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable, EmpiricalVariable, RandomIndices
+from brancher.particle_inference_tools import ParticleSet
+from brancher import inference
+from brancher.inference import StochasticGradientLangevinDynamics as SGLD
+from brancher.inference import StochasticGradientHamiltonianMonteCarlo as SGHMC
+
+# Data
+dataset_size = 1000
+minibatch_size = 50
+data = np.random.normal(1.3, 1., size=(dataset_size, 1)).astype("float32")
+
+# Data sampling model
+minibatch_indices = RandomIndices(dataset_size=dataset_size, batch_size=minibatch_size, name="indices", is_observed=True)
+x_minibatch = EmpiricalVariable(data, indices=minibatch_indices, name="x", is_observed=True)
+
+# Model
+theta = NormalVariable(0., 10., "theta")
+x = NormalVariable(theta, 1., "x")
+model = ProbabilisticModel([x])
+
+# Observations
+x.observe(x_minibatch)
+
+# Exact posterior
+posterior_precision = dataset_size + 1/10.**2
+print("Exact posterior: mean {}, std {}".format(np.sum(data)/posterior_precision, 1/np.sqrt(posterior_precision)))
+
+# Inference: 20 chains of each method
+number_chains = 20
+for inference_method in [SGLD(step_size=5e-5, dataset_size=dataset_size, burn_in=1000, thinning=5),
+                         SGHMC(step_size=5e-6, friction=0.1, dataset_size=dataset_size, burn_in=1000, thinning=5)]:
+    chains = ParticleSet({"theta": np.random.normal(0., 1., size=(number_chains,))})
+    inference.perform_inference(model,
+                                inference_method=inference_method,
+                                number_iterations=4000,
+                                number_samples=number_chains,
+                                posterior_model=chains)
+    samples = list(inference_method.get_samples().values())[0].detach().numpy().flatten()
+    print("{}: mean {}, std {}".format(type(inference_method).__name__, np.mean(samples), np.std(samples)))
+    plt.hist(samples, bins=50, alpha=0.5, density=True, label=type(inference_method).__name__)
+plt.legend()
+plt.show()
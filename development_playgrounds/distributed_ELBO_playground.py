@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable, LogNormalVariable, BetaVariable
+from brancher import inference
+
+# Sample-parallel ELBO estimation with several local processes (gloo backend) #
+number_processes = 4
+number_samples = 200
+number_iterations = 300
+
+
+def run(rank, world_size):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = "29512"
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(1)
+    torch.manual_seed(0) # Same data in all ranks, the samples are offset by rank during the inference
+
+    # Probabilistic model #
+    T = 30
+    nu = LogNormalVariable(0.3, 1., 'nu')
+    x0 = NormalVariable(0., 1., 'x0')
+    b = BetaVariable(0.5, 1.5, 'b')
+    x = [x0]
+    for t in range(1, T):
+        x.append(NormalVariable(b*x[t-1], nu, "x{}".format(t)))
+    AR_model = ProbabilisticModel(x)
+
+    # Generate data #
+    data = AR_model._get_sample(number_samples=1)
+    [xt.observe(data[xt][:, 0, :]) for xt in x]
+
+    # Variational distribution #
+    Qnu = LogNormalVariable(0.5, 1., "nu", learnable=True)
+    Qb = BetaVariable(0.5, 0.5, "b", learnable=True)
+    AR_model.set_posterior_model(ProbabilisticModel([Qb, Qnu]))
+
+    # Inference #
+    inference.perform_inference(AR_model,
+                                number_iterations=number_iterations,
+                                number_samples=number_samples,
+                                optimizer='Adam',
+                                lr=0.05,
+                                distributed_samples=True)
+
+    # The parameters should be identical in all ranks #
+    parameters = torch.cat([parameter.value.detach().flatten()
+                            for var in [Qb, Qnu] for parameter in sorted(var.parents, key=lambda p: p.name)])
+    gathered_parameters = [torch.zeros_like(parameters) for _ in range(world_size)]
+    dist.all_gather(gathered_parameters, parameters)
+    if rank == 0:
+        print("True coefficient: {}".format(float(data[b])))
+        print("Estimated coefficient: {}".format(float(AR_model._get_posterior_sample(1000)[b].mean())))
+        print("Final loss: {}".format(np.mean(AR_model.diagnostics["loss curve"][-10:])))
+        print("Identical parameters across ranks: {}".format(all([torch.equal(p, gathered_parameters[0])
+                                                                  for p in gathered_parameters])))
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    mp.spawn(run, args=(number_processes,), nprocs=number_processes)
@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+# Import time of brancher.functions. Each import is timed in a fresh interpreter #
+# The overhead over importing brancher.variables should stay small since the wrappers are created on demand #
+number_repetitions = 5
+
+
+def time_import(statement):
+    code = "import time; start = time.time(); {}; print(time.time() - start)".format(statement)
+    times = [float(subprocess.check_output([sys.executable, "-c", code]).decode().split()[-1])
+             for _ in range(number_repetitions)]
+    return min(times)
+
+
+torch_time = time_import("import torch")
+variables_time = time_import("import brancher.variables")
+functions_time = time_import("import brancher.functions as BF")
+first_access_time = time_import("import brancher.functions as BF; BF.exp; BF.sigmoid; BF.softplus; BF.matmul")
+
+print("import torch: {:.3f} s".format(torch_time))
+print("import brancher.variables: {:.3f} s".format(variables_time))
+print("import brancher.functions: {:.3f} s (overhead {:.1f} ms)".format(functions_time,
+                                                                        1e3*(functions_time - variables_time)))
+print("import brancher.functions and access 4 functions: {:.3f} s".format(first_access_time))
@@ -0,0 +1,32 @@
+import time
+
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable, BetaVariable
+
+# Construction time of an autoregressive state-space model as a function of its length #
+# The time per time step should stay roughly constant as the chain grows #
+driving_noise = 1.
+measure_noise = 0.5
+
+
+def build_state_space_model(T):
+    b = BetaVariable(0.5, 1., 'b')
+    x = [NormalVariable(0., driving_noise, 'x0')]
+    y = [NormalVariable(x[0], measure_noise, 'y0')]
+    for t in range(1, T):
+        x.append(NormalVariable(b*x[t-1], driving_noise, "x{}".format(t)))
+        y.append(NormalVariable(x[t], measure_noise, "y{}".format(t)))
+    return ProbabilisticModel(x + y)
+
+
+for T in [1000, 2000, 4000, 8000, 16000, 32000, 100000]:
+    start = time.time()
+    model = build_state_space_model(T)
+    construction_time = time.time() - start
+
+    start = time.time()
+    number_variables = len(model._flatten())
+    indexing_time = time.time() - start
+
+    print("T = {}: construction {:.2f} s ({:.1f} us per step), indexing {:.2f} s, {} variables".format(T,
+          construction_time, 1e6*construction_time/T, indexing_time, number_variables))
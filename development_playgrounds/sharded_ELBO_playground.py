@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable, LogNormalVariable
+from brancher import distributed
+from brancher import inference
+
+# Data-sharded ELBO with several local processes (gloo backend) #
+# The sum across ranks of the sharded ELBO and of its gradients should match the single process ELBO #
+number_processes = 4
+number_samples = 50
+number_datapoints = 1000
+number_iterations = 200
+
+
+def build_model(data, sharded):
+    mu = NormalVariable(0., 10., 'mu')
+    sigma = LogNormalVariable(0., 1., 'sigma')
+    x = NormalVariable(mu, sigma, 'x')
+    model = ProbabilisticModel([x])
+    x.observe(data, sharded=sharded)
+    Qmu = NormalVariable(0., 1., 'mu', learnable=True)
+    Qsigma = LogNormalVariable(0., 1., 'sigma', learnable=True)
+    model.set_posterior_model(ProbabilisticModel([Qmu, Qsigma]))
+    return model, [Qmu, Qsigma]
+
+
+def evaluate_ELBO(model, posterior_variables):
+    torch.manual_seed(1)
+    ELBO = model.estimate_log_model_evidence(number_samples)
+    parameters = [parameter.value for var in posterior_variables for parameter in sorted(var.parents,
+                                                                                      key=lambda p: p.name)]
+    gradients = torch.autograd.grad(ELBO, parameters)
+    return ELBO.detach().reshape(1), torch.cat([gradient.flatten() for gradient in gradients])
+
+
+def run(rank, world_size, data):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = "29513"
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(1)
+
+    # Single process ELBO #
+    torch.manual_seed(0)
+    full_model, full_posterior = build_model(data, sharded=False)
+    full_ELBO, full_gradients = evaluate_ELBO(full_model, full_posterior)
+
+    # Sharded ELBO #
+    torch.manual_seed(0)
+    sharded_model, sharded_posterior = build_model(distributed.get_shard(data), sharded=True)
+    sharded_ELBO, sharded_gradients = evaluate_ELBO(sharded_model, sharded_posterior)
+    dist.all_reduce(sharded_ELBO)
+    dist.all_reduce(sharded_gradients)
+    if rank == 0:
+        print("Single process ELBO: {}, sharded ELBO: {}".format(float(full_ELBO), float(sharded_ELBO)))
+        print("Maximum gradient difference: {}".format(float((full_gradients - sharded_gradients).abs().max())))
+
+    # Inference #
+    inference.perform_inference(sharded_model,
+                                number_iterations=number_iterations,
+                                number_samples=number_samples,
+                                optimizer='Adam',
+                                lr=0.05)
+    if rank == 0:
+        posterior_samples = sharded_model._get_posterior_sample(1000)
+        print("Estimated mean: {} (sample mean {})".format(float(posterior_samples[sharded_model.get_variable("mu")].detach().mean()),
+                                                            float(data.mean())))
+        print("Final loss: {}".format(np.mean(sharded_model.diagnostics["loss curve"][-10:])))
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    data = 2. + 0.5*np.random.normal(size=(number_datapoints,))
+    mp.spawn(run, args=(number_processes, data), nprocs=number_processes)
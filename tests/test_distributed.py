@@ -0,0 +1,65 @@
+import os
+import socket
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from context import brancher
+from brancher.variables import ProbabilisticModel, DeterministicVariable
+from brancher.standard_variables import NormalVariable
+from brancher import distributed
+from brancher import inference
+
+number_processes = 2
+number_iterations = 1000
+prior_scale = 1.
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get_MAP_estimate(data, sharded):
+    torch.manual_seed(0)
+    mu = NormalVariable(0., prior_scale, "mu")
+    x = NormalVariable(mu, 1., "x")
+    model = ProbabilisticModel([x])
+    x.observe(distributed.get_shard(data) if sharded else data, sharded=sharded)
+    Qmu = DeterministicVariable(0., "mu", learnable=True)
+    model.set_posterior_model(ProbabilisticModel([Qmu]))
+    inference.perform_inference(model,
+                                inference_method=inference.MAP(),
+                                number_iterations=number_iterations,
+                                number_samples=1,
+                                optimizer="Adam",
+                                lr=0.05)
+    return float(Qmu.value.detach().flatten()[0])
+
+
+def run_sharded_MAP(rank, world_size, port, data, results_path):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(1)
+    estimate = get_MAP_estimate(data, sharded=True)
+    if rank == 0:
+        np.save(results_path, np.array([estimate]))
+    dist.destroy_process_group()
+
+
+def test_sharded_MAP_matches_single_process(tmp_path):
+    data = np.random.RandomState(0).normal(3.5, 1., size=(20,))
+    exact_MAP = np.sum(data)/(len(data) + 1/prior_scale**2)
+    single_process_MAP = get_MAP_estimate(data, sharded=False)
+
+    results_path = str(tmp_path / "sharded_MAP.npy")
+    mp.spawn(run_sharded_MAP, args=(number_processes, get_free_port(), data, results_path),
+             nprocs=number_processes)
+    sharded_MAP = float(np.load(results_path)[0])
+
+    assert np.abs(single_process_MAP - exact_MAP) < 1e-3
+    assert np.abs(sharded_MAP - single_process_MAP) < 1e-3